@@ -19,10 +19,13 @@ import os
 import configparser
 import time
 import logging
+import atexit
 from pkg_resources import resource_filename
 from gdctools.GDCcore import *
 from gdctools.lib import common
 from gdctools.lib import api
+from gdctools.lib import metrics
+from gdctools.lib import codec
 from signal import signal, SIGPIPE, SIG_DFL
 import argparse
 
@@ -42,13 +45,18 @@ class GDCtool(object):
         self.cli.add_argument('-V', '--verbose', dest='verbose',
                 action='count', help=\
                 'Each time specified, increment verbosity level [%(default)s]')
+        self.cli.add_argument('--query-workers', type=int, metavar='N',
+                help='Fetch at most N pages of a GDC query concurrently '
+                '[%d]' % api.get_query_workers())
 
         # Derived classes should add custom options & behavior in their
         # respective __init__/config_customize/execute implementations
 
     def execute(self):
         self.options = self.cli.parse_args()
+        api.clear_memo()
         api.set_verbosity(self.options.verbose)
+        api.set_query_workers(self.options.query_workers)
 
         if not self.config_supported():
             return
@@ -88,6 +96,9 @@ class GDCtool(object):
         self.datestamp = datestamp
         self.init_logging()
 
+        # Summarize requests, retries etc when the tool finishes
+        atexit.register(metrics.report)
+
     def get_values_as_list(self, values):
         if values:
             if type(values) is list:
@@ -186,6 +197,22 @@ class GDCtool(object):
         for var in ["cases", "categories", "projects", "programs"]:
             config[var] = self.get_values_as_list(config[var])
 
+        # Talk to an alternate GDC API server (e.g. a stand-in), if configured
+        api.set_gdc_root(config.gdc_root)
+        if config.retries:
+            api.set_retry_policy(api.RetryPolicy(retries=int(config.retries)))
+        api.set_timeout(read=config.timeout)
+        if config.query_deadline:
+            api.set_deadline(config.query_deadline)
+        if config.hedge_rate:
+            api.set_hedge_rate(config.hedge_rate)
+
+        if config.json_codec:
+            codec.set_codec(config.json_codec)
+
+        # Answer repeated metadata queries from local disk, where possible
+        api.set_cache(config.cache_dir, config.cache_size)
+
     def config_customize(self):
         pass
 
@@ -220,11 +247,13 @@ class GDCtool(object):
             if From.programs:   To.programs   = From.programs
             if From.projects:   To.projects   = From.projects
             if From.cases:      To.cases      = From.cases
+            if From.query_workers: To.query_workers = From.query_workers
 
         config = self.config
         toolname = self.__class__.__name__.split('gdc_')[-1]
         enforce_scope(config[toolname], config)
         enforce_scope(self.options, config)
+        api.set_query_workers(config.query_workers)
 
         # Determine what to ultimately process, noting that
         #
@@ -31,7 +31,7 @@ from gdctools.lib.convert import tsv2idtsv as gdac_tsv2idtsv
 from gdctools.lib.convert import tsv2magetab as gdac_tsv2magetab
 from gdctools.lib.convert import copy as gdac_copy
 from gdctools.lib.convert import maf as maf
-from gdctools.lib import common, meta
+from gdctools.lib import common, meta, codec
 from gdctools.GDCtool import GDCtool
 
 class gdc_dice(GDCtool):
@@ -125,7 +125,7 @@ class gdc_dice(GDCtool):
 
                 # Read metadata into a dict
                 with open(meta_file) as mf:
-                    metadata = json.load(mf)
+                    metadata = codec.load(mf)
 
                 # Subset data to dice by obeying constraints given in CLI/config
                 metadata = constrain(metadata, config)
@@ -24,6 +24,9 @@ from gdctools.lib.api import GDCQuery, _eq_filter as eq_filter, _and_filter as a
 
 features = defaultdict(lambda:None)
 
+# Endpoints of the GDC API which offer no facets, and so cannot be counted
+UNCOUNTABLE = ('programs', 'submission')
+
 def features_identify():
     for name,sym in globals().items():
         if name.startswith("feature_") and isinstance(sym, types.FunctionType):
@@ -81,6 +84,10 @@ def feature_programs(args):
 def call_gdc_api(feature, args, callback=None):
     ''' Issue GDC API call, first parsing filters/fields/expand args from CLI'''
 
+    if (args.count or args.facet) and feature in UNCOUNTABLE:
+        gabort(1, "--count and --facet are not supported for feature: " +
+               args.feature)
+
     query = GDCQuery(feature)
 
     # Ask that result set be pruned, by applying KEY=VALUE filters
@@ -96,6 +103,15 @@ def call_gdc_api(feature, args, callback=None):
     #if args.expand:
     #    query.add_expansions(*(tuple(args.expand)))
 
+    # Counts may be requested instead of results, which are then not fetched
+    if args.facet:
+        query.add_facets(*args.facet)
+        print(json.dumps(query.facets(), indent=2, sort_keys=True))
+        return
+    if args.count:
+        print(query.count())
+        return
+
     results = query.get()
     if not callback or args.raw:
         print(json.dumps(results, indent=2))
@@ -117,6 +133,8 @@ class gdc_list(GDCtool):
             '    gdc_list cases project.project_id=TCGA-ACC\n\n' \
             '    # Shows metadata of all files in TCGA uveal melanoma cohort\n'\
             '    gdc_list files cases.project.project_id=TCGA-UVM\n\n' \
+            '    # Count files in TCGA uveal melanoma cohort, by category and type\n'\
+            '    gdc_list -F data_category -F data_type files cases.project.project_id=TCGA-UVM\n\n' \
             '    # Show what queries may be performed, in summary form\n'\
             '    gdc_list what\n\n' \
             '    # Show open-accss clinical data in TCGA ovarian cohort\n'\
@@ -127,6 +145,12 @@ class gdc_list(GDCtool):
         #cli.add_argument('-e', '--expand', nargs='+',
         #    help='Expand these nested fields')
         #cli.add_argument('-f', '--fields', nargs='+')
+        cli.add_argument('-c', '--count', action='store_true',
+            help='Show only the number of results, without retrieving them')
+        cli.add_argument('-F', '--facet', action='append', default=[],
+            metavar='FIELD',
+            help='Show only the number of results bearing each value of the '\
+                 'given field, without retrieving them; may be repeated')
         cli.add_argument('-n', '--num-results', default=-1, type=int,
             help='return at most this many results')
         cli.add_argument('-r', '--raw', action='store_true',
@@ -18,13 +18,29 @@ import sys
 import os
 import logging
 import time
-import json
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor
 
 from gdctools.GDCcore import *
 from gdctools.GDCtool import GDCtool
 import gdctools.lib.api as api
 import gdctools.lib.meta as meta
 import gdctools.lib.common as common
+import gdctools.lib.metrics as metrics
+import gdctools.lib.codec as codec
+from gdctools.lib.throttle import AdaptiveLimiter
+from gdctools.lib.progress import ProgressLog
+from gdctools.lib.prefetch import Prefetch
+
+# Full metadata records of new or changed files are requested this many at a
+# time, by file id
+FULL_RECORDS_BATCH = 500
+
+# The tool, download budget and log queue inherited by each project worker
+_worker_state = None
 
 class gdc_mirror(GDCtool):
 
@@ -45,9 +61,14 @@ class gdc_mirror(GDCtool):
         cli.add_argument('-f', '--force-download', action='store_true',
                 help='Download files even if already mirrored locally.'+
                 ' (DO NOT use during incremental mirroring)')
-
-        # Detect if we have curl installed
-        self.has_cURL = api.curl_exists()
+        cli.add_argument('-j', '--jobs', type=int, metavar='N',
+                help='Mirror N files concurrently, instead of adapting the '
+                'number between MIN_DOWNLOADS and MAX_DOWNLOADS (as set in '
+                'the [mirror] config section) to the throughput achieved')
+        cli.add_argument('--incremental', default=False, action='store_true',
+                help='Request metadata only of files created or updated '
+                'since the previous mirror, and merely list the ids of the '
+                'rest (see INCREMENTAL in the [mirror] config section)')
 
     def config_customize(self):
         opts = self.options
@@ -61,6 +82,44 @@ class gdc_mirror(GDCtool):
             value = config.mirror.legacy.lower()
             config.mirror.legacy = (value in ["1", "true", "on", "yes"])
 
+        # A fixed number of concurrent downloads may be requested
+        if opts.jobs:
+            config.mirror.min_downloads = opts.jobs
+            config.mirror.max_downloads = opts.jobs
+
+        # Incremental mode may be requested in config file or command line
+        incremental = str(config.mirror.incremental).lower()
+        self.incremental = (opts.incremental or
+                            incremental in ["1", "true", "on", "yes"])
+
+        # Downloads are performed in-process, over pooled connections, unless
+        # cURL is explicitly requested (and installed)
+        use_curl = str(config.mirror.use_curl).lower()
+        self.has_cURL = (use_curl in ["1", "true", "on", "yes"]
+                         and api.curl_exists())
+
+        # Files of at most BULK_MAX_SIZE bytes are mirrored BULK_FILES at a time
+        self.bulk_files = int(config.mirror.bulk_files or 100)
+        self.bulk_max_size = int(config.mirror.bulk_max_size or 10*1024*1024)
+
+        # Files of at least MULTIPART_MIN_SIZE bytes are downloaded as
+        # MULTIPART_PARTS concurrent byte ranges
+        api.set_multipart(config.mirror.multipart_parts,
+                          config.mirror.multipart_min_size)
+
+        # Enough connections are pooled for up to MAX_DOWNLOADS at once
+        api.set_max_downloads(config.mirror.max_downloads or 8)
+
+        # Up to PROJECT_WORKERS projects of a program are mirrored at once,
+        # each in its own process
+        self.project_workers = int(config.mirror.project_workers or 4)
+
+        # The files of the next category of a project are listed in the
+        # background while those of the current category download, holding
+        # at most PREFETCH records (0 lists each category only when reached)
+        prefetch = config.mirror.prefetch
+        self.prefetch = 1000 if prefetch in (None, '') else int(prefetch)
+
         # Allow command line flag to override config file
         if opts.legacy:
             config.mirror.legacy = opts.legacy
@@ -81,19 +140,22 @@ class gdc_mirror(GDCtool):
         if not os.path.isdir(config.mirror.dir):
             os.makedirs(config.mirror.dir)
 
+        # Resolve the program and data categories of every project up front,
+        # with one query, rather than several queries per project
+        plan = api.get_project_plan()
+        all_programs = set(p['program'] for p in plan.values())
+
         # Validate program and project names, if specified
         projects = []
         programs = []
         if config.projects:
-            all_projects = api.get_projects()
             for proj in config.projects:
-                if proj not in all_projects:
+                if proj not in plan:
                     gprint("Project " + proj + " not found in GDC, ignoring")
                 else:
                     projects.append(proj)
 
         if config.programs:
-            all_programs = api.get_programs()
             for prog in config.programs:
                 if prog not in all_programs:
                     # Special handling for certain data not yet exposed by GDC:
@@ -116,11 +178,22 @@ class gdc_mirror(GDCtool):
         logging.info("GDC Mirror Version: %s", self.version)
         logging.info("Command: " + " ".join(sys.argv))
 
+        # The data release is recorded with each project mirrored, so that a
+        # later mirror of the same release may skip listing the project again
+        try:
+            self.data_release = api.get_data_release()
+            logging.info("GDC data release: " + self.data_release)
+        except Exception as e:
+            logging.warning("GDC data release could not be determined, so "
+                            "all projects will be listed in full: " + str(e))
+            self.data_release = None
+
         if not projects:
             logging.info("No projects specified, inferring from programs")
             projects = []
             for prgm in programs:
-                projects_for_this_program = api.get_projects(program=prgm)
+                projects_for_this_program = sorted(p for p in plan
+                                                   if plan[p]['program'] == prgm)
                 logging.info("%d project(s) found for %s: %s" % \
                              (len(projects_for_this_program),
                               prgm, ",".join(projects_for_this_program)))
@@ -129,164 +202,607 @@ class gdc_mirror(GDCtool):
         # Make list of which projects belong to each program
         program_projects = dict()
         for project in projects:
-            prgm = api.get_program(project)
+            prgm = plan[project]['program']
             if prgm not in program_projects: program_projects[prgm] = []
             program_projects[prgm].append(project)
 
+        self.start_downloads()
+
         # Now loop over each program, acquiring lock
+        failed = []
         for prgm in program_projects:
             projects = program_projects[prgm]
             prgm_root = os.path.abspath(os.path.join(config.mirror.dir, prgm))
 
             with common.lock_context(prgm_root, "mirror"):
-                for project in sorted(projects):
-                    self.mirror_project(prgm, project)
+                failed += self.mirror_projects(prgm, sorted(projects), plan)
+
+        self.pool.shutdown()
+        logging.info("Downloaded %.1f MB at %.2f MB/s, with %d failed attempts"
+                     % (self.limiter.total_bytes / 1e6,
+                        self.limiter.throughput() / 1e6,
+                        self.limiter.total_errors))
+        if failed:
+            raise RuntimeError("Mirroring failed for project(s): " +
+                               ", ".join(failed))
 
         # Update the datestamps file with this version of the mirror
         self.update_datestamps_file()
         logging.info("Mirror completed successfully.")
 
-    def __mirror_file(self, file_d, proj_root, n, total, retries=3):
-        '''Mirror a file into <proj_root>/<cat>/<type>.
+    def start_downloads(self, budget=None):
+        '''Create the pool of workers by which files are downloaded, with the
+        number of them active at any time adapted to the throughput achieved
+        (and further bounded by budget, if given)'''
+        limits = self.config.mirror
+        self.limiter = AdaptiveLimiter(limits.min_downloads or 1,
+                                       limits.max_downloads or 8,
+                                       budget=budget)
+        self.pool = ThreadPoolExecutor(max_workers=self.limiter.ceiling)
+
+    def mirror_projects(self, program, projects, plan):
+        '''Mirror the given projects of a program, concurrently if several
+        project workers are configured (and processes may safely be forked):
+        each project is mirrored in a forked process, largest first, while one
+        semaphore shared by them all bounds their downloads in flight to what
+        a single project may have.  The log records of the workers are sent
+        back as they occur, and emitted a project at a time, in the order
+        given: those of the first unfinished project as they arrive, those of
+        the others once it is done.  A project which fails does not stop the
+        rest, in either mode; returns the projects which failed.'''
+        global _worker_state
+        workers = min(self.project_workers, len(projects))
+        if workers > 1 and not _can_fork():
+            logging.info("Project workers require the fork start method of "
+                         "Linux; mirroring projects one at a time")
+            workers = 1
+        failed = []
+        if workers <= 1:
+            for project in projects:
+                if not self.mirror_project_safely(program, project,
+                                                  plan[project]['categories']):
+                    failed.append(project)
+        else:
+            ctx = multiprocessing.get_context('fork')
+            # Records are written to the queue as they are logged, rather
+            # than by a feeder thread, so that they outlive a worker dying
+            log_queue = ctx.SimpleQueue()
+            _worker_state = (self, ctx.BoundedSemaphore(self.limiter.ceiling),
+                             log_queue)
+            logging.info("Mirroring %d projects of %s with %d workers"
+                         % (len(projects), program, workers))
+            try:
+                with ProcessPoolExecutor(max_workers=workers,
+                                         mp_context=ctx) as pool:
+                    largest_first = sorted(projects, key=lambda p:
+                                           -plan[p].get('file_count', 0))
+                    futures = dict((p, pool.submit(_mirror_project_task,
+                                                   program, p,
+                                                   plan[p]['categories']))
+                                   for p in largest_first)
+                    for project in self.__merge_logs(projects, futures,
+                                                     log_queue):
+                        if not self.__project_result(project,
+                                                     futures[project]):
+                            failed.append(project)
+            finally:
+                _worker_state = None
+        return failed
+
+    def mirror_project_safely(self, program, project, categories):
+        '''Mirror one project, logging (rather than raising) any failure;
+        returns whether the project was mirrored'''
+        try:
+            self.mirror_project(program, project, categories)
+            return True
+        except Exception:
+            logging.exception("Mirroring of project %s FAILED:" % project)
+            return False
+
+    def __merge_logs(self, projects, futures, log_queue):
+        '''Emit the log records that project workers send on log_queue, a
+        project at a time in the given order, generating each project once
+        its log is complete'''
+        root_logger = logging.getLogger()
+        held = dict((p, []) for p in projects)
+        done = set()
+        for project in projects:
+            for record in held.pop(project):
+                root_logger.handle(record)
+            while project not in done:
+                if log_queue.empty():
+                    # A worker which died sends no more records
+                    if futures[project].done() and \
+                            futures[project].exception() is not None:
+                        break
+                    time.sleep(0.1)
+                    continue
+                sender, record = log_queue.get()
+                if record is None:
+                    done.add(sender)
+                elif sender in held:
+                    held[sender].append(logging.makeLogRecord(record))
+                else:
+                    root_logger.handle(logging.makeLogRecord(record))
+            yield project
 
-        Files are uniquely identified by uuid.
-        '''
+    def __project_result(self, project, future):
+        '''Merge the metrics and download totals of a project worker into
+        those of this process; returns whether the project was mirrored'''
+        try:
+            snap, nbytes, errors, ok = future.result()
+        except Exception as e:
+            logging.error("Worker mirroring project %s died: %s"
+                          % (project, e))
+            return False
+        metrics.merge(snap)
+        self.limiter.total_bytes += nbytes
+        self.limiter.total_errors += errors
+        return ok
+
+    def __savepath(self, file_d, proj_root):
+        '''Return where file_d is mirrored within proj_root, ensuring that
+        its <root>/<cat>/<type>/ folder exists'''
         strict = not self.config.mirror.legacy
         savepath = meta.mirror_path(proj_root, file_d, strict=strict)
-        dirname, basename = os.path.split(savepath)
-        logging.info("Mirroring file {0} | {1} of {2}".format(basename, n, total))
-
-        #Ensure <root>/<cat>/<type>/ exists
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+        # Tolerates the folder being created concurrently by another download
+        common.safeMakeDirs(os.path.dirname(savepath))
+        return savepath
 
+    def __needs_download(self, file_d, savepath):
+        '''Download if force is enabled or if the file is not on disk'''
+        strict = not self.config.mirror.legacy
         md5path = savepath + ".md5"
+        return (self.force_download
+                or not meta.md5_matches(file_d, md5path, strict)
+                or not os.path.isfile(savepath))
+
+    def __save_md5(self, file_d, savepath):
+        '''Save md5 checksum alongside a successfully mirrored file, whose
+        content has been verified to match that checksum as it downloaded.
+        The sidecar is written atomically, so that a concurrent (or later)
+        reader never sees it partially written.'''
+        md5sum = file_d['md5sum']
+        md5path = savepath + ".md5"
+        md5part = "%s.%d.%d.part" % (md5path, os.getpid(),
+                                     threading.current_thread().ident)
+        with open(md5part, 'w') as mf:
+            mf.write(md5sum + "  " + os.path.basename(savepath))
+        os.rename(md5part, md5path)
+
+    def __mirror_file(self, file_d, proj_root, n, progress, retries=3):
+        '''Mirror a file into <proj_root>/<cat>/<type>, noting its outcome
+        as item n of progress (a ProgressLog).  Any failure is logged, but not
+        raised, so that one file failing does not prevent the rest from being
+        mirrored; failed files remain unmirrored, and so are downloaded again
+        (or resumed, from their .part file) by the next mirror.
 
-        # Download if force is enabled or if the file is not on disk
-        if (self.force_download or not meta.md5_matches(file_d, md5path, strict)
-                or not os.path.isfile(savepath)):
-
-            # New file, mirror to this folder
-            time = 180
-            retry = 0
-            while retry <= retries:
-                try:
-                    #Download file
-                    uuid = file_d['file_id']
+        Files are uniquely identified by uuid.
+        '''
+        basename = file_d.get('file_name') or file_d['file_id']
+        try:
+            savepath = self.__savepath(file_d, proj_root)
+            basename = os.path.basename(savepath)
+            logging.debug("Mirroring file {0} | {1}".format(basename, n))
+            if not self.__needs_download(file_d, savepath):
+                progress.done(n)
+                return
+            size = self.__download_file(file_d, savepath, retries)
+        except Exception:
+            size = None
+            logging.exception("Mirroring of file {0} failed:".format(basename))
+        if size is None:
+            metrics.count("downloads failed")
+            progress.done(n, "Failed to mirror file " + basename, failed=True)
+        else:
+            progress.done(n, "Mirrored file " + basename, nbytes=size)
+
+    def __download_file(self, file_d, savepath, retries):
+        '''Download a file to savepath, retrying as needed, and save its md5
+        sidecar; returns its size, or None if retries were exhausted'''
+        max_time = 180
+        retry = 0
+        while retry <= retries:
+            try:
+                #Download file
+                uuid = file_d['file_id']
+                md5sum = file_d['md5sum']
+                size = file_d.get('file_size')
+                with self.limiter.slot() as slot:
                     if self.has_cURL:
-                        api.curl_download_file(uuid, savepath, max_time=time)
+                        api.curl_download_file(uuid, savepath,
+                                               max_time=max_time,
+                                               md5sum=md5sum,
+                                               file_size=size)
                     else:
-                        api.py_download_file(uuid, savepath)
-                    break
-                except Exception as e:
-                    logging.warning("Download failed: " + str(e) + '\nRetrying...')
-                    retry += 1
-                    # Give some more time, in case the file is large...
-                    # TODO: is this worth it?
-                    time += 180
-
-            if retry > retries:
-                # A partially downloaded file will interfere with subsequent
-                # mirrors
-                common.silent_rm(savepath)
-                logging.error("Error downloading file {0}, too many retries ({1})".format(savepath, retries))
+                        api.py_download_file(uuid, savepath, md5sum=md5sum,
+                                             file_size=size,
+                                             on_retry=self.limiter.error)
+                    slot['bytes'] = size or 0
+                break
+            except Exception as e:
+                logging.warning("Download failed: " + str(e) + '\nResuming...')
+                metrics.count("downloads retried")
+                # Back off, as for failed requests, before resuming
+                time.sleep(api.get_retry_policy().delay(retry))
+                retry += 1
+                # Give cURL some more time, in case the file is large
+                max_time += 180
+
+        if retry > retries:
+            # Whatever was downloaded remains in a .part file, from which
+            # the download resumes upon the next mirror attempt
+            logging.error("Error downloading file {0}, too many retries ({1})".format(savepath, retries))
+            return None
+        self.__save_md5(file_d, savepath)
+        return size or 0
+
+    def __mirror_bulk(self, numbered_files, proj_root, progress):
+        '''Mirror a group of (n, file_dict) pairs with a single request to
+        the GDC, whose response archive is unpacked as it streams in. Files
+        which are not delivered in that archive are then mirrored individually.
+        '''
+        savepaths = dict()
+        checksums = dict()
+        mirrored = set()
+        try:
+            for n, file_d in numbered_files:
+                savepath = self.__savepath(file_d, proj_root)
+                if self.__needs_download(file_d, savepath):
+                    savepaths[file_d['file_id']] = savepath
+                    checksums[file_d['file_id']] = (file_d['md5sum'],
+                                                    file_d.get('file_size'))
+
+            # The GDC returns a lone file verbatim, rather than in an archive
+            if len(savepaths) > 1:
+                logging.debug("Mirroring {0} files in bulk | {1}-{2}".format(
+                              len(savepaths), numbered_files[0][0],
+                              numbered_files[-1][0]))
+                with self.limiter.slot() as slot:
+                    mirrored = api.py_download_files(savepaths,
+                                                checksums=checksums,
+                                                on_retry=self.limiter.error)
+                    slot['bytes'] = sum(checksums[uuid][1] or 0
+                                        for uuid in mirrored)
+                for uuid in mirrored:
+                    self.__save_md5({'md5sum': checksums[uuid][0]},
+                                    savepaths[uuid])
+        except Exception as e:
+            logging.warning("Bulk download failed: " + str(e) +
+                            '\nRetrying files individually...')
+            metrics.count("bulk downloads failed")
+
+        for n, file_d in numbered_files:
+            uuid = file_d['file_id']
+            if uuid in mirrored:
+                progress.done(n, "Mirrored file " +
+                              os.path.basename(savepaths[uuid]),
+                              nbytes=checksums[uuid][1] or 0)
             else:
-                #Save md5 checksum on success
-                md5sum = file_d['md5sum']
-                md5path = savepath + ".md5"
-                with open(md5path, 'w') as mf:
-                    mf.write(md5sum + "  " + basename)
+                self.__mirror_file(file_d, proj_root, n, progress)
 
-    def mirror_project(self, program, project):
-        '''Mirror one project folder'''
+    def mirror_project(self, program, project, gdc_categories=None):
+        '''Mirror one project folder; gdc_categories lists the categories
+        of data the GDC holds for it, if already known'''
 
         datestamp = self.datestamp
         config = self.config
+        strict = not config.mirror.legacy
         logging.info("Mirroring started for {0} ({1})".format(project, program))
 
         categories = config.categories
         if not categories:
             logging.info("No categories specified, using GDC API to " + \
                          "discover ALL available categories")
-            categories = api.get_categories(project)
+            categories = gdc_categories
+            if categories is None:
+                categories = api.get_categories(project)
 
         logging.info("Using %d data categories: %s" % \
                      (len(categories), ",".join(categories)))
         proj_dir = os.path.join(config.mirror.dir, program, project)
         logging.info("Mirroring data to " + proj_dir)
 
-        # Read the previous metadata, if present
-        prev_datestamp = meta.latest_datestamp(proj_dir, None)
-        prev_metadata = []
-        if prev_datestamp is not None:
-            prev_stamp_dir = os.path.join(proj_dir, "metadata", prev_datestamp)
-            prev_metadata = meta.latest_metadata(prev_stamp_dir)
-
-        # Mirror each category separately, recording metadata (file dicts)
-        file_metadata = []
-        for cat in sorted(categories):
-            cat_data = self.mirror_category(program, project, cat,
-                                            self.workflow,
-                                            prev_metadata)
-            file_metadata.extend(cat_data)
+        # What this mirror is synced against: if the previous mirror was of
+        # the same data release and configuration, and all of its files are
+        # intact, the GDC need not be asked for the files of the project again
+        sync = {'data_release' : self.data_release,
+                'legacy' : bool(config.mirror.legacy),
+                'workflow' : self.workflow,
+                'categories' : sorted(categories),
+                'cases' : sorted(config.cases or [])}
+        sync_json = ".".join(["sync", project, datestamp, "json"])
 
         # Record project-level metadata
         # file dicts, counts, redactions, blacklist, etc.
         meta_folder = os.path.join(proj_dir,"metadata")
         stamp_folder = os.path.join(meta_folder, datestamp)
-        if not os.path.isdir(stamp_folder):
-            os.makedirs(stamp_folder)
+        if not os.path.isdir(meta_folder):
+            common.safeMakeDirs(meta_folder)
 
-        # Write file metadata
+        # Note which files of the previous mirror (if any) are still on disk,
+        # and keep their metadata for reuse where they have not changed
+        prev_datestamp = meta.latest_datestamp(proj_dir, None)
+        prev_mirrored = set()
+        prev_records = dict()
+        if prev_datestamp is not None:
+            prev_stamp_dir = os.path.join(meta_folder, prev_datestamp)
+            prev_metadata = meta.latest_metadata(prev_stamp_dir)
+            if self.__unchanged(proj_dir, prev_stamp_dir, prev_metadata, sync):
+                logging.info("GDC data release (%s) and configuration are "
+                             "unchanged since the %s mirror of %s, and all of "
+                             "its files are intact; carrying its metadata "
+                             "forward" % (self.data_release, prev_datestamp,
+                                          project))
+                metrics.count("projects unchanged")
+                self.__carry_forward(prev_stamp_dir, stamp_folder, project)
+                self.__save_sync(os.path.join(stamp_folder, sync_json), sync)
+                return
+            prev_mirrored = meta.mirrored_ids(proj_dir, prev_metadata, strict)
+            prev_records = dict((fd['file_id'], fd) for fd in prev_metadata)
+            del prev_metadata
+
+        # Mirror each category separately, writing file metadata (file dicts)
+        # as it arrives; it is moved into the datestamp folder when complete
         meta_json = ".".join(["metadata", project, datestamp, "json" ])
+        meta_part = os.path.join(meta_folder, "." + meta_json + ".part")
         meta_json = os.path.join(stamp_folder, meta_json)
-        with open(meta_json, 'w') as jf:
-            json.dump(file_metadata, jf, indent=2)
-
-    def mirror_category(self, program, project, category,
-                        workflow, prev_metadata):
-        '''Mirror one category of data in a particular project.
-        Return the mirrored file metadata.
+        # Categories with no files need not be paged through at all
+        counts = api.get_category_counts(project, self.workflow, config.cases)
+        listed = [cat for cat in sorted(categories) if counts.get(cat)]
+        listings = dict()
+        with meta.MetadataWriter(meta_json, meta_part) as writer:
+            try:
+                for cat in sorted(categories):
+                    if not counts.get(cat):
+                        logging.info("No %s files in %s, skipping" % (cat,
+                                                                     project))
+                        continue
+                    # Start listing the next category, to overlap with the
+                    # downloads of this one
+                    if self.prefetch > 0:
+                        i = listed.index(cat)
+                        for c in listed[i:i+2]:
+                            if c not in listings:
+                                listings[c] = self.__prefetch(project, c,
+                                                              prev_records)
+                    self.mirror_category(program, project, cat, self.workflow,
+                                         prev_mirrored, prev_records, writer,
+                                         listings.get(cat))
+                    if cat in listings:
+                        listings.pop(cat).close()
+            finally:
+                # Stop listing ahead, e.g. if a category failed
+                for listing in listings.values():
+                    listing.close()
+        self.__save_sync(os.path.join(stamp_folder, sync_json), sync)
+
+    def __prefetch(self, project, category, prev_records):
+        '''Return a Prefetch of the (query, records) listing of a category,
+        whose log is held until the category is mirrored'''
+        return Prefetch(lambda: self.list_category(project, category,
+                                                   self.workflow, prev_records),
+                        self.prefetch, pair=True,
+                        name="list %s %s" % (project, category),
+                        hold_logs=True)
+
+    def __unchanged(self, proj_dir, prev_stamp_dir, prev_metadata, sync):
+        '''Return True if the mirror recorded in prev_stamp_dir was synced
+        against the same data release and configuration as given in sync, and
+        every file it lists is still on disk, with an intact md5 sidecar'''
+        if self.force_download or sync['data_release'] is None:
+            return False
+        prev_sync = [f for f in os.listdir(prev_stamp_dir)
+                     if f.startswith("sync.") and f.endswith(".json")]
+        if not prev_sync:
+            return False
+        with open(os.path.join(prev_stamp_dir, sorted(prev_sync)[-1])) as f:
+            if codec.load(f) != sync:
+                return False
+        strict = not self.config.mirror.legacy
+        for file_d in prev_metadata:
+            savepath = meta.mirror_path(proj_dir, file_d, strict=strict)
+            if self.__needs_download(file_d, savepath):
+                return False
+        return True
+
+    def __carry_forward(self, prev_stamp_dir, stamp_folder, project):
+        '''Copy the metadata of the previous mirror into this datestamp'''
+        prev_json = meta.latest_metadata_file(prev_stamp_dir)
+        meta_json = ".".join(["metadata", project, self.datestamp, "json"])
+        meta_part = os.path.join(os.path.dirname(stamp_folder),
+                                 "." + meta_json + ".part")
+        meta_json = os.path.join(stamp_folder, meta_json)
+        if os.path.abspath(prev_json) == os.path.abspath(meta_json):
+            return                  # mirrored again within the same day
+        common.safeMakeDirs(stamp_folder)
+        shutil.copyfile(prev_json, meta_part)
+        os.rename(meta_part, meta_json)
+
+    def __save_sync(self, sync_json, sync):
+        with open(sync_json, 'w') as f:
+            codec.dump(sync, f, indent=2, sort_keys=True)
+
+    def list_category(self, project, category, workflow, prev_records):
+        '''Return the query listing the files of one category of a project,
+        and a generator of the full metadata record of each file it lists.
+        When there was a previous mirror, the files are first listed with
+        minimal metadata, and full records requested only for those not in
+        prev_records (or changed since), instead of for every file; a
+        category absent from the previous mirror is listed in full.  In
+        incremental mode the files are instead listed by id alone, and full
+        records requested only for those updated since the latest
+        updated_datetime in prev_records, so that the metadata transferred is
+        proportional to what has changed.'''
+        cases = self.config.cases
+        prev_ids = [uuid for uuid, fd in prev_records.items()
+                    if fd.get('data_category') == category]
+        if prev_ids and self.incremental:
+            since = max(prev_records[uuid].get('updated_datetime') or ''
+                        for uuid in prev_ids)
+            known = self.__updated_records(project, category, workflow,
+                                           prev_records, since)
+            query = api.project_files_query(project, category, workflow,
+                                            cases=cases, profile='ids')
+            records = self.__full_records(query.iter_hits(), project,
+                                          category, workflow, known, 'ids')
+        elif prev_ids:
+            query = api.project_files_query(project, category, workflow,
+                                            cases=cases, profile='minimal')
+            records = self.__full_records(query.iter_hits(), project,
+                                          category, workflow, prev_records)
+        else:
+            query = api.project_files_query(project, category, workflow,
+                                            cases=cases)
+            records = query.iter_hits()
+        return query, records
+
+    def mirror_category(self, program, project, category, workflow,
+                        prev_mirrored, prev_records, writer, listing=None):
+        '''Mirror one category of data in a particular project, writing the
+        metadata of each file in the category with the given MetadataWriter.
+        Files are downloaded as the pages of metadata arrive from the GDC, so
+        the category is never held in memory all at once.  The files are
+        listed by list_category(), unless listing gives a Prefetch of its
+        result, already underway in the background.
         '''
         proj_dir = os.path.join(self.config.mirror.dir, program, project)
         cat_dir = os.path.join(proj_dir, category.replace(' ', '_'))
-        strict = not self.config.mirror.legacy
 
         # Create data folder
         if not os.path.isdir(cat_dir):
             logging.info("Creating folder: " + cat_dir)
-            os.makedirs(cat_dir)
+            common.safeMakeDirs(cat_dir)
 
         # If cases is a list, only files from these cases will be returned,
         # otherwise all files from the category will be
         cases = self.config.cases
-        file_metadata = api.get_project_files(project, category,
-                                              workflow, cases=cases)
-
-        # Filter out extraneous cases from multi-case (e.g. MAF) file metadata
-        # if cases have been specified
-        if cases:
-            for idx, file_dict in enumerate(file_metadata):
-                if len(file_dict.get("cases", [])) > 1:
-                    file_metadata[idx]["cases"] = \
-                    [case for case in file_metadata[idx]["cases"] \
-                     if case["submitter_id"] in cases]
-
-        new_metadata = file_metadata
-
-        # If we aren't forcing a full mirror, check the existing metadata
-        # to see what files are new
-        if not self.force_download:
-            new_metadata = meta.files_diff(proj_dir, file_metadata,
-                                           prev_metadata, strict)
-
-        num_files = len(new_metadata)
-        logging.info("{0} new {1} files".format(num_files, category))
-
-        for n, file_d in enumerate(new_metadata):
-            self.__mirror_file(file_d, proj_dir, n+1, num_files)
-
-        return file_metadata
+        prev_ids = set(uuid for uuid, fd in prev_records.items()
+                       if fd.get('data_category') == category)
+        if listing is None:
+            query, records = self.list_category(project, category, workflow,
+                                                prev_records)
+        else:
+            query, records = listing.ready(), listing
+
+        # Small files are mirrored in groups, one request per group, to avoid
+        # paying a round trip for each of (potentially) many thousands.  Each
+        # file (or group) is downloaded by the pool of workers, subject to the
+        # adaptive concurrency limit.  Their outcomes are logged in listing
+        # order, whatever order they complete in
+        bulk_files = []
+        downloads = set()
+        num_new = 0
+        progress = ProgressLog("%s %s files" % (project, category),
+                               lambda: query.total)
+
+        def schedule(func, *args):
+            # Bound the downloads waiting on workers, so that metadata is not
+            # consumed too far ahead of them
+            while len(downloads) >= 2 * self.limiter.ceiling:
+                done, _ = wait(downloads, return_when=FIRST_COMPLETED)
+                for future in done:
+                    downloads.remove(future)
+                    future.result()
+            downloads.add(self.pool.submit(func, *args))
+
+        for n, file_d in enumerate(records, 1):
+
+            # Filter out extraneous cases from multi-case (e.g. MAF) file
+            # metadata if cases have been specified
+            if cases and len(file_d.get("cases", [])) > 1:
+                file_d["cases"] = [case for case in file_d["cases"] \
+                                   if case["submitter_id"] in cases]
+            writer.write(file_d)
+
+            # If we aren't forcing a full mirror, check the existing metadata
+            # to see what files are new (or have changed)
+            uuid = file_d['file_id']
+            prev_ids.discard(uuid)
+            if (not self.force_download and uuid in prev_mirrored
+                    and file_d['md5sum'] == prev_records[uuid].get('md5sum')):
+                progress.skip(n)
+                continue
+            num_new += 1
+
+            size = file_d.get('file_size')
+            if (self.bulk_files > 1 and size is not None
+                    and size <= self.bulk_max_size):
+                bulk_files.append((n, file_d))
+                if len(bulk_files) == self.bulk_files:
+                    schedule(self.__mirror_bulk, bulk_files, proj_dir,
+                             progress)
+                    bulk_files = []
+            else:
+                schedule(self.__mirror_file, file_d, proj_dir, n, progress)
+
+        if bulk_files:
+            schedule(self.__mirror_bulk, bulk_files, proj_dir, progress)
+        for future in as_completed(downloads):
+            future.result()
+        progress.close()
+
+        logging.info("{0} new {1} files".format(num_new, category))
+        if progress.failed:
+            logging.error("{0} {1} files could not be mirrored".format(
+                          progress.failed, category))
+        if prev_ids:
+            logging.info("{0} {1} files removed since previous mirror".format(
+                         len(prev_ids), category))
+
+    def __updated_records(self, project, category, workflow, prev_records,
+                          since):
+        '''Return prev_records updated with the full records of the files
+        of the category created or updated at or after since (a timestamp)'''
+        logging.info("Requesting %s files updated since %s" % (category, since))
+        query = api.project_files_query(project, category, workflow,
+                                        cases=self.config.cases,
+                                        updated_since=since)
+        known = dict(prev_records)
+        for file_d in query.iter_hits():
+            known[file_d['file_id']] = file_d
+        metrics.count("incremental records", query.total)
+        return known
+
+    def __full_records(self, hits, project, category, workflow, prev_records,
+                       profile='minimal'):
+        '''Generate the full metadata record of each file listed (with the
+        given field profile) in hits, in the same order: records of files
+        unchanged since the previous mirror are taken from prev_records, while
+        the rest are requested from the GDC, FULL_RECORDS_BATCH at a time'''
+        def unchanged(file_d):
+            prev = prev_records.get(file_d['file_id'])
+            return prev is not None and all(file_d.get(field) == prev.get(field)
+                                    for field in api.FILE_PROFILES[profile])
+
+        def complete(batch):
+            wanted = [fd['file_id'] for fd in batch if not unchanged(fd)]
+            full = dict()
+            if wanted:
+                query = api.project_files_query(project, category, workflow,
+                                                cases=self.config.cases,
+                                                file_ids=wanted)
+                full = dict((fd['file_id'], fd) for fd in query.iter_hits())
+                metrics.count("full records", len(wanted))
+            for fd in batch:
+                uuid = fd['file_id']
+                if unchanged(fd):
+                    yield prev_records[uuid]
+                elif uuid in full:
+                    yield full[uuid]
+                else:
+                    # e.g. if the file was removed since being listed
+                    logging.warning("No metadata found for file " + uuid)
+
+        batch = []
+        for file_d in hits:
+            batch.append(file_d)
+            if len(batch) == FULL_RECORDS_BATCH:
+                for record in complete(batch):
+                    yield record
+                batch = []
+        for record in complete(batch):
+            yield record
 
     def execute(self):
         super(gdc_mirror, self).execute()
@@ -312,6 +828,53 @@ class gdc_mirror(GDCtool):
         if stamps[-1] != self.datestamp:
             datestamps_file.write(self.datestamp + '\n')
 
+def _can_fork():
+    '''Whether project workers may be forked: elsewhere than Linux (e.g. on
+    macOS) forking a process which has run threads or SSL is unsafe'''
+    return sys.platform.startswith('linux') and hasattr(os, 'register_at_fork')
+
+class _QueueHandler(logging.Handler):
+    '''Send the log records of a project worker to the parent process, as
+    (project, record dict) pairs'''
+    def __init__(self, log_queue, project):
+        logging.Handler.__init__(self)
+        self.log_queue = log_queue
+        self.project = project
+
+    def emit(self, record):
+        d = dict(record.__dict__)
+        d['msg'] = record.getMessage()
+        d['args'] = None
+        if record.exc_info:
+            d['exc_text'] = logging.Formatter().formatException(
+                                                        record.exc_info)
+        d['exc_info'] = None
+        self.log_queue.put((self.project, d))
+
+def _mirror_project_task(program, project, categories):
+    '''Mirror one project, in a process forked by gdc_mirror.mirror_projects;
+    returns its metrics, bytes downloaded, failed download attempts and
+    whether it succeeded'''
+    tool, budget, log_queue = _worker_state
+    root_logger = logging.getLogger()
+    handlers = root_logger.handlers[:]
+    for h in handlers:
+        root_logger.removeHandler(h)
+    sender = _QueueHandler(log_queue, project)
+    root_logger.addHandler(sender)
+    metrics.reset()
+    tool.start_downloads(budget)
+    try:
+        ok = tool.mirror_project_safely(program, project, categories)
+    finally:
+        tool.pool.shutdown()
+        root_logger.removeHandler(sender)
+        for h in handlers:
+            root_logger.addHandler(h)
+        log_queue.put((project, None))  # the end of its log
+    return (metrics.snapshot(), tool.limiter.total_bytes,
+            tool.limiter.total_errors, ok)
+
 def main():
     gdc_mirror().execute()
 
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+aio.py: asyncio counterparts of GDCQuery and the download functions of
+api.py, whose blocking requests are run on a bounded pool of threads
+'''
+
+# }}}
+
+import asyncio
+import weakref
+import functools
+import threading
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+from gdctools.lib import api
+from gdctools.lib.api import GDCQuery, _decode_json, _log_warnings, _check_hits
+
+__concurrency = 16
+__executor = None
+__limiters = weakref.WeakKeyDictionary()
+__lock = threading.Lock()
+
+class AsyncGDCQuery(GDCQuery):
+    '''Asyncio counterpart of GDCQuery: filters, fields and expansions are
+    added in the same way, but hits are obtained with "await query.get()" or
+    "async for hit in query.iter_hits()", and counts with "await
+    query.count()" or "await query.facets()".  Pages are fetched concurrently,
+    each occupying one of the request slots shared by all async calls.  Note
+    that the on-disk query cache (see api.set_cache) is not consulted.'''
+
+    async def get(self, page_size=500):
+        self.hits = [hit async for hit in self.iter_hits(page_size)]
+        return self.hits
+
+    async def count(self):
+        '''Return how many hits the query matches, without fetching any'''
+        return await _run(GDCQuery.count, self)
+
+    async def facets(self):
+        '''Return the facet counts of the query, as per GDCQuery.facets()'''
+        return await _run(GDCQuery.facets, self)
+
+    def _query_paginator(self, *args, **kwargs):
+        # Would block the event loop
+        raise TypeError("hits of an AsyncGDCQuery are obtained with "
+                        "'await query.get()'")
+
+    async def iter_hits(self, page_size=500):
+        '''Generate hits, page by page, requesting up to client.query_workers
+        pages ahead of the page being consumed'''
+        endpoint = self._base_url()
+        params = self._page_params(page_size, 0)
+
+        r_json, url = await _get_json(self.client, endpoint, params)
+        if self.client.verbosity:
+            print("\nGDC query: %s\n" % url)
+        _log_warnings(r_json, url)
+
+        # See GDCQuery.iter_hits() for why these endpoints are special
+        if self._endpoint in ('submission', 'programs'):
+            if self._endpoint == 'submission':
+                results = [ prog.split('/')[-1] for prog in r_json['links'] ]
+            else:
+                results = await _run(api.get_programs, client=self.client)
+            self.total = len(results)
+            for hit in results:
+                yield hit
+            return
+
+        data = r_json['data']
+        total = data['pagination']['total']
+        self.total = total
+
+        def fetch_page(offset):
+            page_params = dict(params)
+            page_params['from'] = offset
+            return asyncio.ensure_future(_get_json(self.client, endpoint,
+                                                   page_params))
+
+        count = 0
+        ids = set()
+        offsets = iter(range(page_size, total, page_size))
+        pending = deque(fetch_page(offset) for offset in
+                        islice(offsets, self.client.query_workers))
+        hits = data['hits']
+        try:
+            while True:
+                for hit in hits:
+                    if isinstance(hit, dict) and 'id' in hit:
+                        ids.add(hit['id'])
+                    count += 1
+                    yield hit
+                if not pending:
+                    break
+                r_json, _ = await pending.popleft()
+                hits = r_json['data']['hits']
+                for offset in islice(offsets, 1):
+                    pending.append(fetch_page(offset))
+        finally:
+            # Abandoned iteration should not leave requests running
+            for task in pending:
+                task.cancel()
+
+        _check_hits(count, count - len(ids) if ids else 0, total, url)
+
+async def download_file(uuid, file_name, client=None, md5sum=None,
+                        file_size=None):
+    '''Asynchronously download a single file from the GDC, over the given
+    GDCClient (by default, api.get_client()), verifying it against md5sum
+    and/or file_size; returns the response, as per GDCClient.download_file()'''
+    client = client or api.get_client()
+    return await _run(client.download_file, uuid, file_name, md5sum=md5sum,
+                      file_size=file_size)
+
+async def download_files(file_names, client=None, checksums=None):
+    '''Asynchronously download many files from the GDC with one request, as
+    per GDCClient.download_files()'''
+    client = client or api.get_client()
+    return await _run(client.download_files, file_names, checksums=checksums)
+
+def set_concurrency(concurrency):
+    '''Set the maximum number of requests in flight across all async calls'''
+    global __concurrency, __executor
+    previous_value = __concurrency
+    try:
+        concurrency = max(1, int(concurrency))
+    except Exception:
+        return previous_value           # simply keep previous value
+    with __lock:
+        __concurrency = concurrency
+        __limiters.clear()
+        if __executor is not None:
+            __executor.shutdown(wait=False)
+            __executor = None
+    return previous_value
+
+def get_concurrency():
+    return __concurrency
+
+# Module helpers
+def _resources():
+    '''Return the thread pool which performs (blocking) requests, and the
+    semaphore which bounds concurrency within the running event loop'''
+    global __executor
+    loop = asyncio.get_running_loop()
+    with __lock:
+        if __executor is None:
+            __executor = ThreadPoolExecutor(max_workers=__concurrency)
+        limiter = __limiters.get(loop)
+        if limiter is None:
+            limiter = asyncio.Semaphore(__concurrency)
+            __limiters[loop] = limiter
+        return __executor, limiter
+
+async def _run(func, *args, **kwargs):
+    executor, limiter = _resources()
+    async with limiter:
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        return await loop.run_in_executor(executor, call)
+
+def _fetch_json(client, url, params):
+    r = client.send_query(url, params)
+    return _decode_json(r), r.url
+
+async def _get_json(client, url, params):
+    return await _run(_fetch_json, client, url, params)
@@ -14,14 +14,620 @@ GDCQuery class and high-level API functions
 
 import requests
 import json
+import socket
 import logging
 import subprocess
 import os
+import tarfile
+import hashlib
+import threading
+import heapq
+import random
+import time
+import email.utils
+import copy
+from collections import deque, OrderedDict
+from itertools import islice, chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+from gdctools.lib.cache import QueryCache
+from gdctools.lib import metrics
+from gdctools.lib import codec
+from gdctools.lib import prefetch
 
-__legacy = False
-__verbosity = 0
+__client = None
+__client_lock = threading.Lock()
+__memo = OrderedDict()
+__memo_lock = threading.Lock()
+
+# Results of get() are memoized only for queries of these endpoints, whose
+# results are small; file listings are large, and may change within a run.
+# At most MEMO_MAX_ENTRIES results are kept, least recently used going first
+MEMO_ENDPOINTS = ('programs', 'projects')
+MEMO_MAX_ENTRIES = 256
+
+# Connections kept alive per host by the session of each client: at least
+# this many, or more if its concurrency ceilings call for them (see pool_size)
+POOL_MAXSIZE = 32
+
+# Downloads are streamed to disk in chunks of this many bytes: large enough to
+# amortize per-chunk overhead on fast links, small enough to bound memory use
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 logging.getLogger("requests").setLevel(logging.WARNING)
 
+# Fields requested of each file by project_files_query(), by profile: ids
+# suffice to tell which files exist, minimal fields whether a file has changed
+# since it was last seen, while full records are what the mirror saves and
+# downstream tools consume
+FILE_PROFILES = {
+    'ids' : ('file_id',),
+    'minimal' : ('file_id', 'md5sum', 'file_size', 'updated_datetime'),
+    'full' : ('file_id', 'file_name', 'cases.samples.sample_id',
+              'data_type', 'data_category', 'data_format',
+              'experimental_strategy', 'md5sum', 'file_size',
+              'updated_datetime', 'platform', 'tags',
+              'center.namespace', 'cases.submitter_id',
+              'cases.project.project_id',
+              # For protein expression data
+              'cases.samples.portions.submitter_id',
+              # For aliquot-level data
+              'cases.samples.portions.analytes.aliquots.submitter_id')
+}
+
+class RetryPolicy(object):
+    '''How failed requests are retried: up to retries times, after delays
+    growing exponentially from backoff seconds (to at most max_delay), with
+    full jitter so that concurrent workers do not retry in lockstep.  Only
+    ERRORS (connection errors, timeouts, and responses cut short or garbled
+    in transit) and responses with the given statuses are retried; a
+    Retry-After header in such a response is honored.'''
+
+    ERRORS = (requests.exceptions.ConnectionError,
+              requests.exceptions.Timeout,
+              requests.exceptions.ChunkedEncodingError,
+              requests.exceptions.ContentDecodingError)
+
+    def __init__(self, retries=5, backoff=1.0, max_delay=120.0,
+                 statuses=(429, 500, 502, 503, 504)):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.statuses = statuses
+
+    def delay(self, attempt, response=None):
+        '''Return seconds to wait before retrying after the given attempt
+        (numbered from 0), which may have received response'''
+        delay = random.uniform(0, min(self.max_delay,
+                                      self.backoff * 2 ** attempt))
+        retry_after = response is not None and \
+                      response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                # Otherwise it gives the HTTP date at which to retry
+                date = email.utils.parsedate_tz(retry_after)
+                wait = email.utils.mktime_tz(date) - time.time() if date else 0
+            delay = max(delay, min(wait, self.max_delay))
+        return delay
+
+class CircuitBreaker(object):
+    '''Pause all requests once threshold of them have failed in a row, as
+    the GDC is then evidently down: after cooldown seconds a single request
+    is let through to probe it, and the rest resume only if that succeeds.
+    Each consecutive failed probe doubles the pause, up to max_cooldown.'''
+
+    def __init__(self, threshold=8, cooldown=30.0, max_cooldown=600.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._failures = 0
+        self._trips = 0
+        self._open_until = 0
+        self._probing = False
+        self._cond = threading.Condition()
+
+    def wait(self):
+        '''Block until a request may be issued'''
+        with self._cond:
+            while self._failures >= self.threshold:
+                now = time.time()
+                if now < self._open_until:
+                    self._cond.wait(self._open_until - now)
+                elif not self._probing:
+                    self._probing = True
+                    return
+                else:
+                    self._cond.wait(1.0)
+
+    def success(self):
+        with self._cond:
+            self._failures = 0
+            self._trips = 0
+            self._probing = False
+            self._cond.notify_all()
+
+    def failure(self):
+        with self._cond:
+            self._failures += 1
+            now = time.time()
+            if self._failures >= self.threshold and \
+                    (self._probing or self._open_until <= now):
+                pause = min(self.cooldown * 2 ** self._trips, self.max_cooldown)
+                self._trips += 1
+                self._probing = False
+                self._open_until = now + pause
+                metrics.count("circuit breaker trips")
+                logging.warning("GDC appears to be unavailable (%d requests "
+                                "failed in a row), pausing requests for %ds"
+                                % (self._failures, pause))
+            self._cond.notify_all()
+
+class GDCClient(object):
+    '''Everything needed to talk to one GDC archive: the root of its API,
+    whether its legacy archive is addressed, the HTTP session over which
+    requests are pooled, and the policies by which they are retried, timed
+    out and hedged.  Queries and downloads are bound to a client, so that
+    several (e.g. one for each archive) may be used at once, each with its own
+    connections; the module-level functions act upon get_client().
+
+    Sample Usage:
+    legacy = GDCClient(legacy=True)
+    files = legacy.query('files').add_eq_filter('access', 'open').get()
+    legacy.download_file(files[0]['file_id'], 'some_file')
+    '''
+
+    def __init__(self, root=None, legacy=False, verbosity=0, query_workers=4,
+                 cache=None, retry_policy=None, timeout=(15, 120),
+                 hedge_rate=0.05, multipart=(4, 256 * 1024 * 1024),
+                 deadline=600, max_downloads=8):
+        root = root or GDCQuery.GDC_ROOT
+        self.root = root if root.endswith('/') else root + '/'
+        self.legacy = True if legacy else False
+        self.verbosity = verbosity
+        self.query_workers = query_workers
+        self.cache = cache
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.timeout = timeout
+        self.deadline = deadline
+        self.hedge_rate = hedge_rate
+        self.multipart_parts, self.multipart_min_size = multipart
+        self.max_downloads = max_downloads
+        self._session = None
+        self._pool_size = 0
+        self._breaker = None
+        self._hedge_pool = None
+        self._lock = threading.Lock()
+
+    def url(self, endpoint):
+        '''Return the URL of an endpoint (e.g. files, or data/<uuid>)'''
+        return self.root + ('legacy/' if self.legacy else '') + endpoint
+
+    def query(self, endpoint, fields=None, expand=None, filters=None):
+        '''Return a GDCQuery of the given endpoint, bound to this client'''
+        return GDCQuery(endpoint, fields, expand, filters, client=self)
+
+    def session(self):
+        '''Return the HTTP session of this client, so that connections (and
+        their TLS handshakes) are pooled and kept alive across requests,
+        instead of being re-established for each one.  Its pool grows if the
+        concurrency ceilings of the client are raised (see pool_size).'''
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                # Responses (other than downloads, see download_file) are
+                # compressed in transit: file listings shrink many times over
+                self._session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self._pool_size = 0
+            size = self.pool_size()
+            if size > self._pool_size:
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=size)
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+                self._pool_size = size
+            return self._session
+
+    def pool_size(self):
+        '''Return how many connections this client may use at once: each of
+        max_downloads files in flight may be fetched as multipart_parts
+        ranges, while two queries (that being consumed, and that listed
+        ahead of it) each fetch query_workers pages, any of which may be
+        hedged.  This is never less than POOL_MAXSIZE.'''
+        downloads = self.max_downloads * max(1, self.multipart_parts)
+        queries = 2 * self.query_workers * 2
+        return max(POOL_MAXSIZE, downloads + queries)
+
+    def hedge_pool(self):
+        '''Return the pool of threads by which hedged queries are sent, one
+        for each connection that queries may use'''
+        with self._lock:
+            if self._hedge_pool is None:
+                workers = max(POOL_MAXSIZE, 2 * self.query_workers * 2)
+                self._hedge_pool = ThreadPoolExecutor(max_workers=workers)
+            return self._hedge_pool
+
+    def circuit_breaker(self):
+        '''Return the CircuitBreaker shared by all requests of this client'''
+        with self._lock:
+            if self._breaker is None:
+                self._breaker = CircuitBreaker()
+            return self._breaker
+
+    def data_release(self):
+        '''Return the name of the data release currently exposed by the GDC'''
+        r = self.request('GET', self.root + 'status')
+        return _decode_json(r)['data_release']
+
+    def request(self, method, url, on_send=None, on_retry=None, **kwargs):
+        '''Issue a request over the session, retrying as per the retry
+        policy, and subject to the circuit breaker.  The response is returned
+        once it succeeds, or fails in a way not worth retrying (which the
+        caller should check); when retries are exhausted, HTTPError (or the
+        connection error) is raised.  Each attempt is bounded by the timeout,
+        and the response to each query (i.e. not streamed) attempt must also
+        be read in full within deadline seconds; its latency is recorded in
+        metrics.  If given, on_send(t) is called with the time at which each
+        attempt is sent, and on_send(None) when one fails; on_retry(error)
+        is called before each retry, e.g. so that a throttling response
+        promptly cuts the concurrency of the caller.'''
+        policy = self.retry_policy
+        breaker = self.circuit_breaker()
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            breaker.wait()
+            metrics.count("requests")
+            response = None
+            try:
+                start = time.time()
+                if on_send:
+                    on_send(start)
+                if kwargs.get('stream'):
+                    response = self.session().request(method, url, **kwargs)
+                else:
+                    response = self._read_within(self.deadline, method, url,
+                                                 kwargs)
+                    metrics.sample("query latency", time.time() - start)
+                    _count_bytes(response)
+                if response.status_code not in policy.statuses:
+                    breaker.success()
+                    return response
+                error = requests.exceptions.HTTPError("%d %s for url: %s" %
+                            (response.status_code, response.reason, url),
+                            response=response)
+                response.close()
+            except RetryPolicy.ERRORS as e:
+                error = e
+            except Exception:
+                # Not worth retrying, but the breaker must learn of it, lest
+                # it wait forever upon the outcome of a probe
+                if on_send:
+                    on_send(None)
+                breaker.failure()
+                metrics.count("requests failed")
+                raise
+
+            if on_send:
+                on_send(None)
+            breaker.failure()
+            if attempt >= policy.retries:
+                metrics.count("requests failed")
+                raise error
+            if on_retry:
+                on_retry(error)
+            delay = policy.delay(attempt, response)
+            metrics.count("requests retried")
+            logging.warning("GDC request failed (%s), retrying in %.1fs"
+                            % (error, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def _read_within(self, seconds, method, url, kwargs):
+        '''Issue a request and read its whole response within the given
+        seconds, raising Timeout if it takes longer: the read timeout bounds
+        only each read, so a response trickling in could otherwise take any
+        length of time'''
+        start = time.time()
+        response = self.session().request(method, url, stream=True, **kwargs)
+        expired = threading.Event()
+        def expire():
+            expired.set()
+            try:
+                # Unblocks the read in progress, which then fails
+                response.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+        timer = threading.Timer(max(0, start + seconds - time.time()), expire)
+        timer.daemon = True
+        timer.start()
+        try:
+            response.content
+        except Exception:
+            if not expired.is_set():
+                raise
+        finally:
+            timer.cancel()
+        if expired.is_set():
+            response.close()
+            raise requests.exceptions.Timeout("Response not read within %ds "
+                                              "for url: %s" % (seconds, url))
+        return response
+
+    def send_query(self, url, params, on_send=None):
+        '''Issue a query of the given parameters, by GET or, if they are too
+        long to fit within a URL, by POST (as a JSON body, which the GDC
+        accepts in the same form except that filters are given as an object)'''
+        request = requests.Request('GET', url, params=params).prepare()
+        if len(request.url) <= GDCQuery.MAX_URL_LENGTH:
+            return self.request('GET', url, params=params, on_send=on_send)
+        body = dict(params)
+        if 'filters' in body:
+            body['filters'] = json.loads(body['filters'])
+        return self.request('POST', url, json=body, on_send=on_send)
+
+    def hedged_query(self, url, params):
+        '''Issue a query as per send_query(), but if it takes longer than the
+        95th percentile of recent query latencies, issue a duplicate (a
+        "hedge") and return whichever response arrives first, so that one slow
+        server or connection does not stall the query.  The query is timed
+        from when it is actually sent (i.e. not while it waits for a worker or
+        backs off before a retry).  At most hedge_rate of queries are hedged,
+        to bound the extra load upon the GDC.'''
+        metrics.count("queries")
+        threshold = None
+        if metrics.get_count("queries hedged") < \
+                self.hedge_rate * metrics.get_count("queries"):
+            threshold = metrics.percentile("query latency", 95, min_samples=20)
+        if threshold is None:
+            return self.send_query(url, params)
+
+        # Wait until the attempt in flight has taken threshold seconds
+        sent = [None]
+        cond = threading.Condition()
+        def on_send(t):
+            with cond:
+                sent[0] = t
+                cond.notify_all()
+        def on_done(future):
+            with cond:
+                cond.notify_all()
+
+        pool = self.hedge_pool()
+        primary = pool.submit(prefetch.carried(self.send_query), url, params,
+                              on_send)
+        primary.add_done_callback(on_done)
+        with cond:
+            while not primary.done():
+                if sent[0] is None:
+                    cond.wait()         # not yet sent, or backing off
+                    continue
+                remaining = sent[0] + threshold - time.time()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+        if primary.done():
+            return primary.result()
+        metrics.count("queries hedged")
+        hedge = pool.submit(prefetch.carried(self.send_query), url, params)
+
+        # Take the first to succeed, or failing that the last to fail
+        futures = [primary, hedge]
+        while True:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None or not futures:
+                    if future is hedge:
+                        metrics.count("queries won by hedge")
+                    return future.result()
+
+    def download_file(self, uuid, file_name, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                      md5sum=None, file_size=None, on_retry=None):
+        """Download a single file from GDC, over the pooled session.
+
+        Content is streamed to <file_name>.part, which is renamed to file_name
+        only when complete.  If a .part file remains from an earlier,
+        interrupted attempt then the download resumes from its end, by way of
+        a Range request.  The content is hashed as it streams in, and when
+        md5sum and/or file_size are given an IOError is raised if the
+        downloaded file does not match.  Files of at least multipart_min_size
+        bytes are instead downloaded as several concurrent byte ranges (see
+        _download_ranges).  on_retry is passed to request().  Returns the
+        response to the (last) request for the file, which includes its
+        status_code, http headers, etc; or None if none was needed.
+        """
+        url = self.url('data/' + uuid)
+        part_name = file_name + '.part'
+
+        parts, min_size = self.multipart_parts, self.multipart_min_size
+        resume = _load_ranges(part_name, md5sum, file_size)
+        if resume or (file_size and parts > 1 and file_size >= min_size):
+            try:
+                return self._download_ranges(url, file_name, file_size, parts,
+                                        md5sum, chunk_size, resume, on_retry)
+            except _RangesUnsupported:
+                logging.info("Server does not support ranges, downloading %s "
+                             "as a single stream" % file_name)
+
+        # Ranges refer to the bytes of the file as stored, so ask that they not
+        # be transparently compressed in transit
+        headers = {'Accept-Encoding': 'identity'}
+        digest = hashlib.md5()
+        offset = os.path.getsize(part_name) if os.path.isfile(part_name) else 0
+        if offset:
+            logging.info("Resuming download of %s at byte %d"
+                         % (file_name, offset))
+            headers['Range'] = 'bytes=%d-' % offset
+            _hash_file(part_name, digest, chunk_size)
+
+        with self.request('GET', url, stream=True, headers=headers,
+                          on_retry=on_retry) as r:
+            if r.status_code == 416 and _content_length(r) == offset:
+                pass                        # .part was already complete
+            else:
+                r.raise_for_status()
+                # The server may disregard the Range, and send the entire file
+                mode = 'ab'
+                if r.status_code != 206:
+                    mode = 'wb'
+                    digest = hashlib.md5()
+                with open(part_name, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            digest.update(chunk)
+                            f.write(chunk)
+
+        _verify_download(part_name, digest.hexdigest(), md5sum, file_size)
+        _rename(part_name, file_name)
+        return r
+
+    def download_files(self, file_names, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                       checksums=None, on_retry=None):
+        """Download many files from the GDC with one request.  The GDC
+        responds with an archive of <uuid>/<file_name> members, which is
+        unpacked as it streams in, so that each member is written directly to
+        file_names[uuid] (by way of a .part file) and the archive itself never
+        touches the disk.  Each member is hashed as it is written; if checksums
+        maps its uuid to an (md5sum, file_size) pair, then a member failing to
+        match is discarded.  Returns the set of uuids that were written.
+        on_retry is passed to request()."""
+        url = self.url('data')
+        checksums = checksums or dict()
+        written = set()
+        with self.request('POST', url, json={'ids': sorted(file_names)},
+                          stream=True, on_retry=on_retry) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            with tarfile.open(fileobj=r.raw, mode='r|*') as archive:
+                for member in archive:
+                    uuid = member.name.split('/')[0]
+                    if not member.isfile() or uuid not in file_names:
+                        continue                    # e.g. MANIFEST.txt
+                    source = archive.extractfile(member)
+                    part_name = file_names[uuid] + '.part'
+                    digest = hashlib.md5()
+                    with open(part_name, 'wb') as f:
+                        read = lambda: source.read(chunk_size)
+                        for chunk in iter(read, b''):
+                            digest.update(chunk)
+                            f.write(chunk)
+                    md5sum, file_size = checksums.get(uuid, (None, None))
+                    try:
+                        _verify_download(part_name, digest.hexdigest(),
+                                         md5sum, file_size)
+                    except IOError as e:
+                        logging.warning(str(e))
+                        continue
+                    _rename(part_name, file_names[uuid])
+                    written.add(uuid)
+        return written
+
+    def _download_ranges(self, url, file_name, file_size, parts, md5sum=None,
+                         chunk_size=DOWNLOAD_CHUNK_SIZE, resume=None,
+                         on_retry=None):
+        '''Download a file of file_size bytes as (up to) parts concurrent byte
+        ranges, each written in place within a .part file preallocated to that
+        size, so that no stitching of pieces is needed.  The progress of every
+        range is recorded in a .part.ranges file as it downloads, so that an
+        interrupted download resumes where each of its ranges left off (resume
+        being the (file_size, ranges) read back by _load_ranges).  Once all
+        ranges are complete the file is hashed, verified and renamed, as by
+        download_file, which the response to the last range requested is
+        returned to (None if every range was already complete).  Raises
+        _RangesUnsupported if the server ignores Range requests, in which
+        case the .part file is removed.'''
+        part_name = file_name + '.part'
+        ranges_name = part_name + '.ranges'
+        ranges = None
+        if resume:
+            file_size, ranges = resume
+        if ranges is None:
+            # Any existing .part file is a prefix, from a single stream
+            done = 0
+            if os.path.isfile(part_name):
+                done = os.path.getsize(part_name)
+            done = min(done, file_size)
+            step = max(-(-(file_size - done) // parts), 1)
+            ranges = [[start, start, min(start + step, file_size)]
+                      for start in range(done, file_size, step)]
+            with open(part_name, 'r+b' if done else 'wb') as f:
+                f.truncate(file_size)
+            _save_ranges(ranges_name, file_size, md5sum, ranges)
+        else:
+            logging.info("Resuming ranged download of %s" % file_name)
+
+        lock = threading.Lock()
+        unsupported = threading.Event()
+
+        def fetch(rng):
+            # Each range is a list of [start, next byte wanted, end]
+            pos, end = rng[1], rng[2]
+            headers = {'Accept-Encoding': 'identity',
+                       'Range': 'bytes=%d-%d' % (pos, end - 1)}
+            with self.request('GET', url, stream=True, headers=headers,
+                              on_retry=on_retry) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    unsupported.set()
+                    return r
+                with open(part_name, 'r+b') as f:
+                    f.seek(pos)
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if unsupported.is_set() or pos >= end:
+                            break
+                        chunk = chunk[:end - pos]
+                        f.write(chunk)
+                        f.flush()
+                        pos += len(chunk)
+                        with lock:
+                            rng[1] = pos
+                            _save_ranges(ranges_name, file_size, md5sum,
+                                         ranges)
+            return r
+
+        # The response to the final range stands for the whole download
+        response = None
+        pending = [rng for rng in ranges if rng[1] < rng[2]]
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                for future in [pool.submit(fetch, rng) for rng in pending]:
+                    response = future.result()
+
+        if unsupported.is_set():
+            for name in (part_name, ranges_name):
+                if os.path.isfile(name):
+                    os.remove(name)
+            raise _RangesUnsupported(url)
+        if any(rng[1] < rng[2] for rng in ranges):
+            raise IOError("Incomplete ranged download of %s" % part_name)
+
+        os.remove(ranges_name)
+        digest = _hash_file(part_name, hashlib.md5(), chunk_size)
+        _verify_download(part_name, digest.hexdigest(), md5sum, file_size)
+        _rename(part_name, file_name)
+        return response
+
+    def curl_download_file(self, uuid, file_name, max_time=180, md5sum=None,
+                           file_size=None):
+        """Download a single file from the GDC, using cURL.  As with
+        download_file, an interrupted download is resumed from its .part
+        file, and verified against md5sum and/or file_size (if given) once
+        complete"""
+        url = self.url('data/' + uuid)
+        part_name = file_name + '.part'
+        curl_args = ['curl', '--max-time', str(max_time), '--fail',
+                     '--continue-at', '-', '-o', part_name, url]
+        result = subprocess.check_call(curl_args)
+        if md5sum:
+            # cURL runs out of process, so its output must be read back
+            digest = _hash_file(part_name, hashlib.md5()).hexdigest()
+        else:
+            digest = None
+        _verify_download(part_name, digest, md5sum, file_size)
+        _rename(part_name, file_name)
+        return result
+
 class GDCQuery(object):
     # Class variables
     ENDPOINTS = ('cases', 'files', 'programs', 'projects', 'submission')
@@ -30,13 +636,23 @@ class GDCQuery(object):
     # Queries returning more than this many results will log a warning
     WARN_RESULT_CT = 5000
 
-    def __init__(self, endpoint, fields=None, expand=None, filters=None):
+    # Queries too long to fit within a URL of this length are sent by POST
+    MAX_URL_LENGTH = 4096
+
+    # An IN filter of more values than this is split into several queries,
+    # which are run concurrently and their results merged
+    MAX_IN_VALUES = 1000
+
+    def __init__(self, endpoint, fields=None, expand=None, filters=None,
+                 client=None):
         self._endpoint = endpoint.lower()               # normalize to lowercase
+        self.client = client or get_client()
         assert(endpoint in GDCQuery.ENDPOINTS)
         # Make copies of all mutable
         self._fields   = fields if fields else []
         self._expand   = expand if expand else []
         self._filters  = filters if filters else []
+        self._facets   = []
 
     def add_eq_filter(self, field, value):
         self._filters.append(_eq_filter(field, value))
@@ -46,8 +662,13 @@ class GDCQuery(object):
         self._filters.append(_neq_filter(field, value))
         return self
 
+    def add_gte_filter(self, field, value):
+        self._filters.append(_gte_filter(field, value))
+        return self
+
     def add_in_filter(self, field, values):
         self._filters.append(_in_filter(field,values))
+        return self
 
     def filters(self):
         return self._filters
@@ -60,6 +681,55 @@ class GDCQuery(object):
         self._expand.extend(fields)
         return self
 
+    def add_facets(self, *fields):
+        '''Request counts of hits by value of these fields; see facets()'''
+        self._facets.extend(fields)
+        return self
+
+    def count(self):
+        '''Return how many hits the query matches, without fetching any'''
+        return self._preflight()['pagination']['total']
+
+    def facets(self):
+        '''Return a dict mapping each facet field to a dict of the number of
+        hits bearing each of its values, again without fetching any hits'''
+        aggregations = self._preflight().get('aggregations', {})
+        counts = dict()
+        for field, agg in aggregations.items():
+            counts[field] = dict((b['key'], b['doc_count'])
+                                 for b in agg.get('buckets', []))
+        return counts
+
+    def _preflight(self):
+        '''Issue the query with size=0, so that only the pagination and
+        aggregations (facet counts) sections of the response are returned'''
+        params = self._params()
+        params['size'] = 0
+        if self._facets:
+            params['facets'] = ','.join(self._facets)
+        return _memoized([self._base_url(), params],
+                         lambda: self._fetch_preflight(params))
+
+    def _fetch_preflight(self, params):
+        cache = self.client.cache
+        if cache is not None:
+            params['legacy'] = self.client.legacy
+            key = cache.key(self._base_url(), params)
+            del params['legacy']
+            entry = cache.load(key)
+            if entry is not None:
+                return list(entry[1])[0]
+
+        r = self.client.hedged_query(self._base_url(), params)
+        if self.client.verbosity:
+            print("\nGDC query: %s\n" % r.url)
+        r_json = _decode_json(r)
+        _log_warnings(r_json, r.url)
+        data = r_json['data']
+        if cache is not None:
+            list(cache.record(key, [data]))
+        return data
+
     def url(self):
         '''For debugging purposes, build a PreparedRequest to show the url.'''
         req = requests.Request('GET', self._base_url(), params=self._params())
@@ -67,10 +737,7 @@ class GDCQuery(object):
         return r.url
 
     def _base_url(self):
-        url = GDCQuery.GDC_ROOT
-        if get_legacy(): url += 'legacy/'
-        url += self._endpoint
-        return url
+        return self.client.url(self._endpoint)
 
     def _params(self):
         params = dict()
@@ -85,12 +752,11 @@ class GDCQuery(object):
                 params['filters'] = json.dumps(_and_filter(self._filters))
         return params
 
-    def _query_paginator(self, page_size=500, from_idx=0, to_idx=-1):
-        '''Returns list of hits, iterating over server paging'''
-        endpoint = self._base_url()
-        p = self._params()
-        p['from'] = from_idx
-        p['size'] = page_size
+    def _page_params(self, page_size, from_idx):
+        '''Return request parameters for the page of hits at from_idx'''
+        params = self._params()
+        params['from'] = from_idx
+        params['size'] = page_size
 
         # For pagination to work, the records must specify a sort order. This
         # lookup tells the right field to use based on the endpoint
@@ -98,13 +764,50 @@ class GDCQuery(object):
                         'cases' : 'case_id',
                         'projects' : 'project_id',
                         'submission': 'links'}
+        params['sort'] = sort_lookup.get(self._endpoint, "")
+        return params
+
+    def iter_hits(self, page_size=500, from_idx=0, to_idx=-1):
+        '''Generate hits, page by page.  After the first page reveals how many
+        hits there are in total, subsequent pages are requested concurrently,
+        but no more than client.query_workers pages ahead of the page being
+        consumed; memory use is thus bounded by that window, regardless of the
+        number of hits.  The total is recorded in .total after the first page.
+        If a query cache is enabled, hits are replayed from (or recorded to) it.
+        Queries with a very large IN filter are split, as per _iter_chunks().
+        '''
+        chunks = self._chunks() if (from_idx, to_idx) == (0, -1) else None
+        if chunks:
+            for hit in self._iter_chunks(chunks, page_size):
+                yield hit
+            return
 
-        endpoint_name = endpoint.rstrip('/').split('/')[-1]
-        p['sort'] = sort_lookup.get(endpoint_name, "")
+        cache = self.client.cache
+        if cache is None:
+            for hit in self._iter_pages(page_size, from_idx, to_idx):
+                yield hit
+            return
+
+        params = self._params()
+        params.update({'from': from_idx, 'to': to_idx, 'legacy': self.client.legacy})
+        key = cache.key(self._base_url(), params)
+        entry = cache.load(key)
+        if entry is None:
+            hits = cache.record(key, self._iter_pages(page_size, from_idx, to_idx))
+        else:
+            self.total, hits = entry
+        for hit in hits:
+            yield hit
+
+    def _iter_pages(self, page_size, from_idx, to_idx):
+        '''Generate hits directly from the GDC, for iter_hits()'''
+        endpoint = self._base_url()
+        endpoint_name = self._endpoint
+        p = self._page_params(page_size, from_idx)
 
         # Make initial call
-        r = requests.get(endpoint, params=p)
-        if get_verbosity():
+        r = self.client.hedged_query(endpoint, p)
+        if self.client.verbosity:
             print("\nGDC query: %s\n" % r.url)
         r_json = _decode_json(r)
 
@@ -116,58 +819,153 @@ class GDCQuery(object):
         if endpoint_name == 'submission':
             results = r_json['links']
             results = [ program.split('/')[-1] for program in results ]
-            self.hits = results
-            return results
+            self.total = len(results)
+            for hit in results:
+                yield hit
+            return
 
         # The 'programs' endpoint does not actually exist in GDC api (but has
         # been requested by Broad). Until then we fake it for convenience.
         if endpoint_name == 'programs':
-            self.hits = get_programs()
-            return self.hits
+            results = get_programs(client=self.client)
+            self.total = len(results)
+            for hit in results:
+                yield hit
+            return
 
         # Get first page of hits, and pagination data
         data = r_json['data']
-        all_hits = data['hits']
         pagination = data['pagination']
-        total = pagination['total'] if to_idx == -1 else to_idx
+        total = pagination['total']
+        if to_idx != -1:
+            total = min(total, to_idx)
+        self.total = total
 
         # Some queries can return a large number of results, warn here
         if total > GDCQuery.WARN_RESULT_CT:
             logging.warning(str(total) + " files match this query, paging "
                             + "through all results may take some time")
 
-        for from_idx in range(page_size+1, total, page_size):
-            #Iterate over pages to get the remaning hits
-            p['from'] = from_idx
-            r = requests.get(endpoint, params=p)
+        def fetch_page(offset):
+            params = dict(p)
+            params['from'] = offset
+            r = self.client.hedged_query(endpoint, params)
+            return _decode_json(r)['data']['hits']
+
+        # Pages are consumed in offset order, which preserves the sort order
+        # requested of the server, while the next few are being fetched
+        expected = max(total - from_idx, 0)
+        count = 0
+        ids = set()
+        offsets = iter(range(from_idx + page_size, total, page_size))
+        workers = self.client.query_workers
+        fetch_page = prefetch.carried(fetch_page)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque(pool.submit(fetch_page, offset)
+                            for offset in islice(offsets, workers))
+            hits = data['hits']
+            while True:
+                # Chop off hits on the last page if they exceed to_idx
+                for hit in hits[:expected - count]:
+                    if isinstance(hit, dict) and 'id' in hit:
+                        ids.add(hit['id'])
+                    count += 1
+                    yield hit
+                if not pending:
+                    break
+                hits = pending.popleft().result()
+                for offset in islice(offsets, 1):
+                    pending.append(pool.submit(fetch_page, offset))
 
-            hits = _decode_json(r)['data']['hits']
-            all_hits.extend(hits)
+        _check_hits(count, count - len(ids) if ids else 0, expected, r.url)
 
-        self.hits = all_hits
-        return all_hits # Chop off hits on the last page if they exceed to_idx
+    def _chunks(self):
+        '''Return a list of queries which together cover this one, each with
+        at most MAX_IN_VALUES values in its largest IN filter; or None if this
+        query need not be split'''
+        in_filters = [(len(f['content']['value']), i)
+                      for i, f in enumerate(self._filters) if f['op'] == 'in']
+        if not in_filters:
+            return None
+        size, index = max(in_filters)
+        if size <= GDCQuery.MAX_IN_VALUES:
+            return None
+
+        field = self._filters[index]['content']['field']
+        values = self._filters[index]['content']['value']
+        chunks = []
+        for start in range(0, size, GDCQuery.MAX_IN_VALUES):
+            filters = list(self._filters)
+            filters[index] = _in_filter(field,
+                                values[start:start + GDCQuery.MAX_IN_VALUES])
+            chunks.append(self.__class__(self._endpoint, list(self._fields),
+                                         list(self._expand), filters,
+                                         client=self.client))
+        return chunks
+
+    def _iter_chunks(self, chunks, page_size):
+        '''Generate the hits of several queries merged into one stream, in
+        order of id (which the hits of each query are sorted by), and dropping
+        any hit matched by more than one query (e.g. a file of many cases).
+        The first page of each query is fetched concurrently, and subsequent
+        pages are prefetched as usual.  Note that .total may overcount, as
+        it is the sum of the totals of each query.'''
+        def start(query):
+            hits = query.iter_hits(page_size)
+            for hit in hits:
+                return chain([hit], hits)
+            return iter([])
+
+        workers = min(self.client.query_workers, len(chunks))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            streams = list(pool.map(prefetch.carried(start), chunks))
+        self.total = sum(query.total for query in chunks)
+
+        def keyed(n, stream):
+            for hit in stream:
+                yield (hit['id'], n), hit
+
+        last = None
+        merged = heapq.merge(*[keyed(n, s) for n, s in enumerate(streams)])
+        for (uuid, _), hit in merged:
+            if uuid != last:
+                yield hit
+            last = uuid
+
+    def _query_paginator(self, page_size=500, from_idx=0, to_idx=-1):
+        '''Returns list of hits, iterating over server paging.  The result
+        is memoized, as per _memoized(), for queries of MEMO_ENDPOINTS'''
+        def fetch():
+            hits = list(self.iter_hits(page_size, from_idx, to_idx))
+            return self.total, hits
+        if self._endpoint not in MEMO_ENDPOINTS:
+            self.total, self.hits = fetch()
+            return self.hits
+        key = [self._base_url(), self._params(), page_size, from_idx, to_idx]
+        self.total, self.hits = _memoized(key, fetch)
+        return self.hits
 
     def get(self, page_size=500):
         return self._query_paginator(page_size=page_size)
 
-def get_projects(program=None):
-    query = GDCQuery('projects')
+def get_projects(program=None, client=None):
+    query = GDCQuery('projects', client=client)
     if program:
         query.add_eq_filter('program.name', program)
     query.add_fields('project_id')
     projects = [d['project_id'] for d in query.get()]
     return sorted(projects)
 
-def get_project_from_cases(cases, program=None):
+def get_project_from_cases(cases, program=None, client=None):
     if not cases: return []
-    query = GDCQuery('cases')
+    query = GDCQuery('cases', client=client)
     query.add_in_filter('submitter_id', cases)
     query.add_fields('project.project_id')
     projects = [p['project']['project_id'] for p in query.get()]
     return sorted(set(projects))
 
-def get_categories(project):
-    query = GDCQuery('projects')
+def get_categories(project, client=None):
+    query = GDCQuery('projects', client=client)
     query.add_eq_filter('project_id', project)
     query.add_fields('summary.data_categories.data_category')
     projects = query.get()
@@ -182,30 +980,78 @@ def get_categories(project):
     else:
         return [] # Needed to protect against projects with no data
 
+def get_project_plan(programs=None, client=None):
+    '''Return a dict mapping each project (optionally restricted to the given
+    programs) to a dict of its 'program' name, its data 'categories' and its
+    'file_count' (of files of any access level).  All
+    are resolved by one paged projects query, rather than one or more queries
+    per project, so that the cost of planning a mirror does not grow with the
+    number of projects.'''
+    query = GDCQuery('projects', client=client)
+    if programs:
+        query.add_in_filter('program.name', list(programs))
+    query.add_fields('project_id', 'program.name', 'summary.file_count',
+                     'summary.data_categories.data_category')
+    plan = dict()
+    for proj in query.iter_hits():
+        summary = proj.get('summary', {})
+        categories = summary.get('data_categories', [])
+        plan[proj['project_id']] = {
+            'program' : proj['program']['name'],
+            'categories' : [d['data_category'] for d in categories],
+            'file_count' : summary.get('file_count', 0)
+        }
+    return plan
+
+def get_category_counts(project_id, workflow_type=None, cases=None,
+                        client=None):
+    '''Return a dict mapping each data category of a project to its number
+    of open access files, from one facet query which fetches no files.  Note
+    that these are upper bounds upon the hits of project_files_query(), which
+    prunes some categories further.'''
+    query = GDCQuery('files', client=client)
+    query.add_eq_filter("cases.project.project_id", project_id)
+    query.add_eq_filter("access", "open")
+    if workflow_type and not query.client.legacy:
+        query.add_eq_filter('analysis.workflow_type', workflow_type)
+    if cases:
+        query.add_in_filter('cases.submitter_id', cases)
+    query.add_facets('data_category')
+    return query.facets().get('data_category', {})
+
 def get_project_files(project_id, data_category, workflow_type=None, cases=None,
-                      page_size=500):
-    query = GDCQuery('files')
+                      page_size=500, client=None):
+    query = project_files_query(project_id, data_category, workflow_type, cases,
+                                client=client)
+    return query.get(page_size=page_size)
+
+def project_files_query(project_id, data_category, workflow_type=None,
+                        cases=None, profile='full', file_ids=None,
+                        updated_since=None, client=None):
+    '''Return a GDCQuery for the files of one data category in a project,
+    which may be run all at once with get() or streamed with iter_hits().  The
+    profile names which fields of each file to request (see FILE_PROFILES),
+    file_ids optionally restricts the query to those files, and updated_since
+    to those created or updated at or after that (updated_datetime) time.'''
+    query = GDCQuery('files', client=client)
     query.add_eq_filter("cases.project.project_id", project_id)
     query.add_eq_filter("files.data_category", data_category)
     query.add_eq_filter("access", "open")
+    if updated_since:
+        query.add_gte_filter("updated_datetime", updated_since)
 
-    if not __legacy:
+    if not query.client.legacy:
         if workflow_type:
             query.add_eq_filter('analysis.workflow_type', workflow_type)
-        query.add_fields('analysis.workflow_type')
+        if profile == 'full':
+            query.add_fields('analysis.workflow_type')
 
     if cases:
         query.add_in_filter('cases.submitter_id', cases)
+    if file_ids:
+        query.add_in_filter('file_id', list(file_ids))
 
-    query.add_fields('file_id', 'file_name', 'cases.samples.sample_id',
-                     'data_type', 'data_category', 'data_format',
-                     'experimental_strategy', 'md5sum','platform','tags',
-                     'center.namespace', 'cases.submitter_id',
-                     'cases.project.project_id',
-                     # For protein expression data
-                     'cases.samples.portions.submitter_id',
-                     # For aliquot-level data
-                     'cases.samples.portions.analytes.aliquots.submitter_id')
+    query.add_fields(*FILE_PROFILES[profile])
 
     # Prune Clinical/Biospecimen data, by avoiding download/mirror of
     #   - path reports/images (Data Type: Slide Image), as they can be huge
@@ -217,8 +1063,9 @@ def get_project_files(project_id, data_category, workflow_type=None, cases=None,
     elif data_category == "Clinical":
         query.add_neq_filter("data_format", "BCR Biotab")
 
-    query.add_expansions('cases', 'annotations', 'cases.samples')
-    return query.get(page_size=page_size)
+    if profile == 'full':
+        query.add_expansions('cases', 'annotations', 'cases.samples')
+    return query
 
 def curl_exists():
     """ Return true if curl can be executed on this system """
@@ -230,33 +1077,29 @@ def curl_exists():
     except (OSError, subprocess.CalledProcessError):
         return False
 
-def py_download_file(uuid, file_name, chunk_size=4096):
-    """Download a single file from GDC."""
-    url = GDCQuery.GDC_ROOT
-    if __legacy: url += 'legacy/'
-    url += 'data/' + uuid
-    r = requests.get(url, stream=True)
-    # TODO: Optimize chunk size
-    # Larger chunk size == more memory, but fewer packets
-    with open(file_name, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            if chunk:
-                f.write(chunk)
-
-    # Return the response, which includes status_code, http headers, etc.
-    return r
-
-def curl_download_file(uuid, file_name, max_time=180):
-    """Download a single file from the GDC, using cURL"""
-    url = GDCQuery.GDC_ROOT
-    if __legacy: url += 'legacy/'
-    url += 'data/' + uuid
-    curl_args = ['curl', '--max-time', str(max_time), '--fail', '-o', file_name, url]
-    return subprocess.check_call(curl_args)
-
-def get_program(project):
+def py_download_file(uuid, file_name, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                     md5sum=None, file_size=None, on_retry=None):
+    '''Download a single file from the GDC, as per GDCClient.download_file()'''
+    return get_client().download_file(uuid, file_name, chunk_size,
+                                      md5sum, file_size, on_retry)
+
+def py_download_files(file_names, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                      checksums=None, on_retry=None):
+    '''Download many files from the GDC with one request, as per
+    GDCClient.download_files()'''
+    return get_client().download_files(file_names, chunk_size, checksums,
+                                       on_retry)
+
+def curl_download_file(uuid, file_name, max_time=180, md5sum=None,
+                       file_size=None):
+    '''Download a single file from the GDC using cURL, as per
+    GDCClient.curl_download_file()'''
+    return get_client().curl_download_file(uuid, file_name, max_time,
+                                           md5sum, file_size)
+
+def get_program(project, client=None):
     '''Return the program name of a project.'''
-    query = GDCQuery('projects')
+    query = GDCQuery('projects', client=client)
     query.add_eq_filter('project_id', project)
     query.add_fields('program.name')
     projects = query.get()
@@ -269,7 +1112,7 @@ def get_program(project):
 
     return projects[0]['program']['name']
 
-def get_programs(projects=None):
+def get_programs(projects=None, client=None):
     '''Return list of programs that have data EXPOSED in GDC.  Note that this
        may be different from the set of programs that have SUBMITTED data to
        the GDC, because (a) it takes time to validate submissions before GDC
@@ -279,9 +1122,9 @@ def get_programs(projects=None):
        '''
 
     if projects:
-        projects = list(set(projects) & set(get_projects()))
+        projects = list(set(projects) & set(get_projects(client=client)))
     else:
-        projects = get_projects()
+        projects = get_projects(client=client)
     programs  = [ proj.split('-')[0] for proj in projects]
     return list(set(programs))
 
@@ -301,41 +1144,361 @@ def _eq_filter(field, value):
 def _neq_filter(field, value):
     return {"op" : "!=", "content" : {"field" : field, "value" : [value]}}
 
+def _gte_filter(field, value):
+    return {"op" : ">=", "content" : {"field" : field, "value" : value}}
+
 def _and_filter(filters):
     return {"op" : "and", "content" : filters}
 
 def _in_filter(field, values):
     return {"op" : "in", "content" : {"field": field, "value": values} }
 
+def _memoized(key, compute):
+    '''Return the result of compute(), calling it only once for each
+    (JSON-serializable) key until clear_memo() or its eviction: later callers
+    with the same key are given the same result, and concurrent callers wait
+    for the first to finish rather than repeating its work.  Each caller
+    receives its own deep copy of the result, which it may modify freely.
+    Failures are not memoized.'''
+    key = json.dumps(key, sort_keys=True)
+    with __memo_lock:
+        future = __memo.pop(key, None)
+        owner = future is None
+        if owner:
+            future = Future()
+        elif future.done():
+            metrics.count("memoized queries hits")
+        else:
+            metrics.count("memoized queries coalesced")
+        __memo[key] = future            # now the most recently used
+        while len(__memo) > MEMO_MAX_ENTRIES:
+            __memo.popitem(last=False)
+
+    if owner:
+        metrics.count("memoized queries misses")
+        try:
+            future.set_result(compute())
+        except Exception as e:
+            with __memo_lock:
+                if __memo.get(key) is future:
+                    del __memo[key]
+            future.set_exception(e)
+            raise
+    return copy.deepcopy(future.result())
+
+def clear_memo():
+    '''Forget all memoized query results, e.g. at the start of each run of a
+    tool in a long-running process'''
+    with __memo_lock:
+        __memo.clear()
+
+def _count_bytes(response):
+    '''Count the bytes of a (fully read) response received over the wire,
+    which may be compressed, and once decoded'''
+    try:
+        received = response.raw.tell()
+    except Exception:
+        return
+    if received:
+        metrics.count("query bytes received", received)
+        metrics.count("query bytes decoded", len(response.content))
+
+def _check_hits(count, duplicates, expected, r_url):
+    '''Ensure that a paged query returned exactly the number of (distinct)
+    hits the server promised, so that a dropped or duplicated page (e.g. from
+    data being released while paging) fails loudly instead of silently'''
+    if count != expected or duplicates:
+        emsg = "GDC query returned %d hits (%d duplicated), but %d expected"
+        emsg = emsg % (count, duplicates, expected)
+        emsg += "\nRequest URL: " + r_url
+        raise ValueError(emsg)
+
+def _content_length(response):
+    '''Return the full length of the file, per the Content-Range header of a
+    response to a Range request (or None if it cannot be determined)'''
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        return int(content_range.split('/')[-1])
+    except ValueError:
+        return None
+
+def _hash_file(file_name, digest, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    '''Update digest with the content of file_name, and return it'''
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest
+
+def _verify_download(part_name, digest, md5sum=None, file_size=None):
+    '''Raise IOError if a downloaded .part file does not have the expected
+    size and md5 digest.  A file which is merely short is kept, so that its
+    download may be resumed; otherwise it is corrupt, and is removed.'''
+    size = os.path.getsize(part_name)
+    if file_size is not None and size < file_size:
+        raise IOError("Incomplete download of %s: %d of %d bytes" % \
+                      (part_name, size, file_size))
+    if file_size is not None and size != file_size:
+        os.remove(part_name)
+        raise IOError("Download of %s has %d bytes, but %d expected" % \
+                      (part_name, size, file_size))
+    if md5sum and digest != md5sum:
+        os.remove(part_name)
+        raise IOError("Download of %s has md5 %s, but %s expected" % \
+                      (part_name, digest, md5sum))
+
+class _RangesUnsupported(IOError):
+    pass
+
+def _save_ranges(ranges_name, file_size, md5sum, ranges):
+    '''Record the progress of a ranged download, atomically'''
+    with open(ranges_name + '.tmp', 'w') as f:
+        json.dump({'size': file_size, 'md5': md5sum, 'ranges': ranges}, f)
+    _rename(ranges_name + '.tmp', ranges_name)
+
+def _load_ranges(part_name, md5sum=None, file_size=None):
+    '''Return the (file_size, ranges) recorded for a ranged download of
+    part_name, or None if there is no record.  A record is trusted only if it
+    is for a file of the given md5sum and file_size, and its .part file has
+    been preallocated to that size; otherwise the record and .part file are
+    discarded, as the bytes not yet written would pass for downloaded ones'''
+    ranges_name = part_name + '.ranges'
+    if not os.path.isfile(ranges_name):
+        return None
+    try:
+        with open(ranges_name) as f:
+            saved = json.load(f)
+        size, ranges = saved['size'], saved['ranges']
+        valid = file_size in (None, size) and \
+                md5sum in (None, saved.get('md5')) and \
+                os.path.isfile(part_name) and \
+                os.path.getsize(part_name) == size and \
+                all(0 <= start <= pos <= end <= size
+                    for start, pos, end in ranges)
+    except (ValueError, KeyError, TypeError):
+        valid = False
+    if valid:
+        return size, ranges
+    logging.warning("Discarding stale ranged download of %s" % part_name)
+    for name in (part_name, ranges_name):
+        if os.path.isfile(name):
+            os.remove(name)
+    return None
+
+def _rename(source, dest):
+    '''Atomically move source to dest, replacing dest if it exists'''
+    if hasattr(os, 'replace'):
+        os.replace(source, dest)
+    else:
+        os.rename(source, dest)
+
 def _decode_json(request):
-    """ Attempt to decode response from request using the .json() method.
+    """ Attempt to decode response from request, with the codec module.
 
     If one cannot be decoded, raise a more useful error than the default by
     printing the text content, rather than just raising a ValueError"""
     try:
-        return request.json()
+        return codec.loads(request.content)
     except ValueError:
         emsg = "No JSON object could be decoded from response. Content:\n"
         emsg += request.text
         raise ValueError(emsg)
 
+def set_client(client):
+    '''Make client the default GDCClient, i.e. the one used by queries and
+    downloads for which none is given; returns the previous default'''
+    global __client
+    with __client_lock:
+        previous_value = __client
+        __client = client
+    return previous_value
+
+def get_client():
+    '''Return the default GDCClient, creating it upon first use'''
+    global __client
+    with __client_lock:
+        if __client is None:
+            __client = GDCClient()
+        return __client
+
+def _after_fork():
+    '''Give a forked child process its own locks, hedging threads and (for
+    the default client) connections, rather than sharing those of its parent'''
+    global __client_lock, __memo_lock
+    __client_lock = threading.Lock()
+    __memo_lock = threading.Lock()
+    if __client is not None:
+        __client._session = None
+        __client._breaker = None
+        __client._hedge_pool = None
+        __client._lock = threading.Lock()
+        if __client.cache is not None:
+            __client.cache._lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def get_session():
+    '''Return the HTTP session of the default client'''
+    return get_client().session()
+
+def set_gdc_root(root):
+    '''Direct all queries and downloads to the GDC API served at root (e.g.
+    a local stand-in, see gdctools.lib.standin), instead of the public GDC'''
+    client = get_client()
+    previous_value = client.root
+    if root:
+        client.root = root if root.endswith('/') else root + '/'
+    return previous_value
+
+def get_gdc_root():
+    return get_client().root
+
+def get_data_release():
+    '''Return the name of the data release currently exposed by the GDC'''
+    return get_client().data_release()
+
+def set_cache(cache_dir, max_megabytes=None):
+    '''Persist query results within cache_dir, keeping at most max_megabytes
+    of them, until the GDC publishes a new data release.  A cache_dir of None
+    disables caching.  Returns the QueryCache (if any) now in use.'''
+    client = get_client()
+    client.cache = None
+    if not cache_dir:
+        return None
+    try:
+        release = client.data_release()
+    except Exception as e:
+        logging.warning("Query cache disabled, as GDC data release could not "
+                        "be determined: " + str(e))
+        return None
+    max_bytes = int(float(max_megabytes or 1024) * 1024 * 1024)
+    client.cache = QueryCache(cache_dir, release, max_bytes)
+    return client.cache
+
+def get_cache():
+    return get_client().cache
+
+def set_retry_policy(policy):
+    '''Set the RetryPolicy of all requests; None restores the default'''
+    client = get_client()
+    previous_value = client.retry_policy
+    client.retry_policy = policy or RetryPolicy()
+    return previous_value
+
+def get_retry_policy():
+    return get_client().retry_policy
+
+def get_circuit_breaker():
+    '''Return the CircuitBreaker shared by all requests'''
+    return get_client().circuit_breaker()
+
+def set_timeout(connect=None, read=None):
+    '''Set the seconds allowed for connecting to the GDC, and for each read
+    of a response (i.e. the longest the GDC may remain silent), after which a
+    request is abandoned (and retried); returns the previous values'''
+    client = get_client()
+    previous_value = client.timeout
+    try:
+        client.timeout = (float(connect) if connect else previous_value[0],
+                          float(read) if read else previous_value[1])
+    except Exception:
+        pass                            # simply keep previous values
+    return previous_value
+
+def get_timeout():
+    return get_client().timeout
+
+def set_deadline(seconds):
+    '''Set the seconds within which the whole response to a query must be
+    read, after which it is abandoned (and retried); returns the previous
+    value'''
+    client = get_client()
+    previous_value = client.deadline
+    try:
+        client.deadline = float(seconds)
+    except Exception:
+        pass                            # simply keep previous value
+    return previous_value
+
+def get_deadline():
+    return get_client().deadline
+
+def set_hedge_rate(rate):
+    '''Set the largest fraction of queries which may be hedged (0 disables
+    hedging); see GDCClient.hedged_query()'''
+    client = get_client()
+    previous_value = client.hedge_rate
+    try:
+        client.hedge_rate = max(0.0, float(rate))
+    except Exception:
+        pass                            # simply keep previous value
+    return previous_value
+
+def get_hedge_rate():
+    return get_client().hedge_rate
+
+def set_multipart(parts=None, min_size=None):
+    '''Download files of at least min_size bytes as this many concurrent
+    byte ranges (parts of 1 or less disables this); returns previous values'''
+    client = get_client()
+    previous_value = (client.multipart_parts, client.multipart_min_size)
+    try:
+        if parts is not None:
+            client.multipart_parts = int(parts)
+        if min_size is not None:
+            client.multipart_min_size = int(min_size)
+    except Exception:
+        pass                            # simply keep previous values
+    return previous_value
+
+def get_multipart():
+    client = get_client()
+    return (client.multipart_parts, client.multipart_min_size)
+
+def set_max_downloads(downloads):
+    '''Set the maximum number of files downloaded concurrently, so that
+    enough connections are pooled for them; returns previous value'''
+    client = get_client()
+    previous_value = client.max_downloads
+    try:
+        client.max_downloads = max(1, int(downloads))
+    except Exception:
+        pass                            # simply keep previous value
+    return previous_value
+
+def get_max_downloads():
+    return get_client().max_downloads
+
 def set_legacy(legacy=False):
-    global __legacy
-    previous_value = __legacy
-    __legacy = True if legacy else False
+    client = get_client()
+    previous_value = client.legacy
+    client.legacy = True if legacy else False
     return previous_value
 
 def get_legacy():
-    return __legacy
+    return get_client().legacy
 
 def set_verbosity(verbosity):
-    global __verbosity
-    previous_value = __verbosity
+    client = get_client()
+    previous_value = client.verbosity
     try:
-        __verbosity = int(verbosity)
+        client.verbosity = int(verbosity)
     except Exception:
         pass                            # simply keep previous value
     return previous_value
 
 def get_verbosity():
-    return __verbosity
+    return get_client().verbosity
+
+def set_query_workers(workers):
+    '''Set the maximum number of pages fetched concurrently per query'''
+    client = get_client()
+    previous_value = client.query_workers
+    try:
+        client.query_workers = max(1, int(workers))
+    except Exception:
+        pass                            # simply keep previous value
+    return previous_value
+
+def get_query_workers():
+    return get_client().query_workers
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+cache.py: on-disk cache of GDC query results, emptied whenever the
+GDC data release changes
+'''
+
+# }}}
+
+import os
+import json
+import errno
+import hashlib
+import logging
+import threading
+from gdctools.lib import codec
+
+# Each entry begins with a fixed-width header line giving its number of hits,
+# which is (re)written in place once every hit has been recorded
+_HEADER = '%20d\n'
+
+class QueryCache(object):
+    '''Cache of query results within cache_dir, holding at most max_bytes of
+    entries: when that cap is exceeded, the least recently used entries are
+    discarded.  Each entry is a JSON-lines file, so that hits can be recorded
+    and replayed one at a time, without holding them all in memory.
+
+    Sample Usage:
+    cache = QueryCache(cache_dir, "Data Release 12.0")
+    key = cache.key(url, params)
+    entry = cache.load(key)
+    if entry is None:
+        hits = cache.record(key, hits)
+    '''
+
+    RELEASE_FILE = 'RELEASE'
+
+    def __init__(self, cache_dir, data_release, max_bytes=1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Results from an earlier data release may now be stale
+        release_file = os.path.join(cache_dir, QueryCache.RELEASE_FILE)
+        previous = None
+        if os.path.isfile(release_file):
+            with open(release_file) as f:
+                previous = f.read().strip()
+        if previous != data_release:
+            if previous is not None:
+                logging.info("GDC data release changed from '%s' to '%s', "
+                             "clearing query cache" % (previous, data_release))
+            self.clear()
+            with open(release_file, 'w') as f:
+                f.write(data_release + '\n')
+
+    def key(self, url, params):
+        '''Return the cache key for a query of url with the given parameters'''
+        query = json.dumps({'url': url, 'params': params}, sort_keys=True)
+        return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        '''Return (total, generator of hits) for a cached query, or None'''
+        path = self._path(key)
+        try:
+            f = open(path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        # Note that the entry is recently used, for LRU eviction
+        os.utime(path, None)
+        total = int(f.readline())
+
+        def hits():
+            with f:
+                for line in f:
+                    yield codec.loads(line)
+        return total, hits()
+
+    def record(self, key, hits):
+        '''Generate hits while recording them; the entry is committed only
+        once the hits are exhausted, so partial results are never cached'''
+        path = self._path(key)
+        part = '%s.%d.%d.part' % (path, os.getpid(), threading.current_thread().ident)
+        count = 0
+        try:
+            with open(part, 'w') as f:
+                f.write(_HEADER % 0)
+                for hit in hits:
+                    f.write(codec.dumps(hit) + '\n')
+                    count += 1
+                    yield hit
+                f.seek(0)
+                f.write(_HEADER % count)
+            os.rename(part, path)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+        self.evict()
+
+    def evict(self):
+        '''Discard least recently used entries until within max_bytes'''
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            size = sum(e[1] for e in entries)
+            for mtime, bytes, path in sorted(entries):
+                if size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= bytes
+
+    def clear(self):
+        '''Discard all entries'''
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.json') or name.endswith('.part'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+codec.py: the JSON codec with which GDC responses and metadata files are
+read and written (orjson or ujson, when installed)
+'''
+
+# }}}
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+CODECS = ('orjson', 'ujson', 'json')
+__codec = 'orjson' if orjson else ('ujson' if ujson else 'json')
+
+def loads(data):
+    '''Decode a JSON document, given as str or bytes; raises ValueError if
+    it is not valid JSON'''
+    if __codec == 'orjson':
+        return orjson.loads(data)
+    if __codec == 'ujson':
+        return ujson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+def load(f):
+    return loads(f.read())
+
+def dumps(obj, indent=None, sort_keys=False):
+    '''Encode obj as JSON text, laid out as by json.dumps(obj, indent=indent,
+    sort_keys=sort_keys) but for the separators of compact (unindented) text,
+    which may omit spaces.  Objects holding floats are encoded by json, as
+    the faster codecs format some floats differently (e.g. 1e16, not 1e+16)'''
+    text = None
+    try:
+        if _has_float(obj):
+            text = None                 # formatted as json formats them
+        elif __codec == 'orjson' and indent in (None, 2):
+            option = orjson.OPT_INDENT_2 if indent else 0
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            text = orjson.dumps(obj, option=option).decode('utf-8')
+        elif __codec == 'ujson':
+            text = ujson.dumps(obj, indent=indent or 0, sort_keys=sort_keys,
+                               escape_forward_slashes=False)
+    except (TypeError, OverflowError):
+        text = None                     # e.g. a type only json can encode
+    if text is None or not _is_ascii(text):
+        text = json.dumps(obj, indent=indent, sort_keys=sort_keys)
+    return text
+
+def dump(obj, f, indent=None, sort_keys=False):
+    f.write(dumps(obj, indent=indent, sort_keys=sort_keys))
+
+def set_codec(name=None):
+    '''Use the named codec (one of CODECS), or the fastest installed if name
+    is None; returns the previous codec.  Unknown or uninstalled codecs are
+    ignored, keeping the previous codec.'''
+    global __codec
+    previous_value = __codec
+    if name is None:
+        __codec = 'orjson' if orjson else ('ujson' if ujson else 'json')
+    elif name == 'json' or (name == 'orjson' and orjson) or \
+            (name == 'ujson' and ujson):
+        __codec = name
+    return previous_value
+
+def get_codec():
+    return __codec
+
+def _has_float(obj):
+    if isinstance(obj, float):
+        return True
+    if isinstance(obj, dict):
+        return any(_has_float(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_float(v) for v in obj)
+    return False
+
+def _is_ascii(text):
+    try:
+        text.encode('ascii')
+        return True
+    except UnicodeError:
+        return False
@@ -17,6 +17,7 @@ import json
 import logging
 import csv
 from gdctools.lib.common import DATESTAMP_REGEX, ANNOT_TO_DATATYPE
+from gdctools.lib import codec
 from collections import namedtuple, defaultdict
 
 # Lightweight class to enable handling of aggregate projects
@@ -87,29 +88,76 @@ def append_metadata(file_dicts, metafile):
     dicts = []
     if os.path.isfile(metafile):
         with open(metafile) as f:
-            dicts.extend(json.load(f))
+            dicts.extend(codec.load(f))
 
     # Add file_dicts and overwrite
     dicts.extend(file_dicts)
     with open(metafile, 'w') as out:
-        json.dump(dicts, out, indent=2)
+        codec.dump(dicts, out, indent=2)
 
 def latest_metadata(stamp_dir):
+    with open(latest_metadata_file(stamp_dir)) as jsonf:
+        return codec.load(jsonf)
+
+def latest_metadata_file(stamp_dir):
+    '''Return the path of the metadata file within a datestamp folder'''
     metadata_files = [f for f in os.listdir(stamp_dir)
                       if os.path.isfile(os.path.join(stamp_dir, f))
                       and "metadata" in f]
     # Get the chronologically latest one, in case there is more than one,
     # Should just be a sanity check
     latest = sorted(metadata_files)[-1]
-    latest = os.path.join(stamp_dir, latest)
-    with open(latest) as jsonf:
-        return json.load(jsonf)
+    return os.path.join(stamp_dir, latest)
+
+class MetadataWriter(object):
+    '''Incrementally write file dicts to a JSON metadata file, in the same
+    layout as json.dump(file_dicts, f, indent=2) but without needing to hold
+    them all in memory.  Content is written to part_path, which is moved to
+    path only when the writer is closed without error, so that an aborted
+    run never leaves a truncated metadata file behind.
+
+    Sample Usage:
+    with MetadataWriter(metafile, part_path) as writer:
+        for file_dict in file_dicts:
+            writer.write(file_dict)
+    '''
+
+    def __init__(self, path, part_path):
+        self.path = path
+        self.part_path = part_path
+        self.count = 0
+        self._file = open(part_path, 'w')
+        self._file.write('[')
+
+    def write(self, file_dict):
+        entry = codec.dumps(file_dict, indent=2).replace('\n', '\n  ')
+        self._file.write((',\n  ' if self.count else '\n  ') + entry)
+        self.count += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.write('\n]' if self.count else ']')
+        self._file.close()
+        if exc_type is not None:
+            os.remove(self.part_path)
+            return
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        os.rename(self.part_path, self.path)
+
+def mirrored_ids(proj_root, file_dicts, strict=True):
+    '''Returns the set of file ids in file_dicts whose file is present on
+    disk in the mirror rooted at proj_root'''
+    return {fd['file_id'] for fd in file_dicts
+            if os.path.isfile(mirror_path(proj_root, fd, strict))}
 
 def files_diff(proj_root, new_files, old_files, strict=True):
     '''Returns the file dicts in new_files that aren't in old_files.
     Also checks that the file is present on disk.'''
-    old_uuids = {fd['file_id'] for fd in old_files
-                if os.path.isfile(mirror_path(proj_root, fd, strict))}
+    old_uuids = mirrored_ids(proj_root, old_files, strict)
     new_dicts = [fd for fd in new_files if fd['file_id'] not in old_uuids]
     return new_dicts
 
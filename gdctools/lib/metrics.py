@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+metrics.py: thread-safe counters and samples gathered over a run, and
+reported when GDCtools exit
+'''
+
+# }}}
+
+import os
+import logging
+import threading
+from collections import deque
+
+# Percentiles are of the latest SAMPLE_WINDOW samples of each name, so that
+# the cost of computing them (e.g. for every hedged query) stays bounded
+SAMPLE_WINDOW = 1000
+
+__counts = dict()
+__samples = dict()
+__sampled = dict()                      # number of samples ever taken
+__lock = threading.Lock()
+
+def count(name, n=1):
+    '''Add n to the counter of the given name'''
+    with __lock:
+        __counts[name] = __counts.get(name, 0) + n
+
+def get_count(name):
+    return __counts.get(name, 0)
+
+def sample(name, value):
+    '''Record one observation (e.g. a latency, in seconds) of the given name'''
+    with __lock:
+        _window(name).append(value)
+        __sampled[name] = __sampled.get(name, 0) + 1
+
+def percentile(name, p, min_samples=1):
+    '''Return the p-th percentile (0 to 100) of the latest samples of the
+    given name, or None if there are fewer than min_samples of them'''
+    with __lock:
+        values = sorted(__samples.get(name, []))
+    if not values or len(values) < min_samples:
+        return None
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def reset():
+    with __lock:
+        __counts.clear()
+        __samples.clear()
+        __sampled.clear()
+
+def snapshot():
+    '''Return a copy of the counters and samples gathered so far, e.g. to
+    be merged into those of another process'''
+    with __lock:
+        return (dict(__counts),
+                dict((name, list(v)) for name, v in __samples.items()),
+                dict(__sampled))
+
+def merge(snap):
+    '''Add the counters and samples of a snapshot() to those gathered here'''
+    counts, samples, sampled = snap
+    with __lock:
+        for name, n in counts.items():
+            __counts[name] = __counts.get(name, 0) + n
+        for name, values in samples.items():
+            _window(name).extend(values)
+        for name, n in sampled.items():
+            __sampled[name] = __sampled.get(name, 0) + n
+
+def _window(name):
+    window = __samples.get(name)
+    if window is None:
+        window = __samples[name] = deque(maxlen=SAMPLE_WINDOW)
+    return window
+
+def _after_fork():
+    # The lock may have been held by another thread of the parent process
+    global __lock
+    __lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def report():
+    '''Log every counter, and the median/95th/99th percentiles of the latest
+    samples of each name, gathered so far'''
+    with __lock:
+        counts = sorted(__counts.items())
+        names = sorted(__samples)
+    if not (counts or names):
+        return
+    lines = ["%s: %d" % (name, n) for name, n in counts]
+
+    # Give the hit rate of each set of "<X> misses", "<X> hits" and (hits
+    # which waited upon a miss in progress) "<X> coalesced" counters
+    counts = dict(counts)
+    for name in sorted(counts):
+        if name.endswith(" misses"):
+            prefix = name[:-len(" misses")]
+            hits = counts.get(prefix + " hits", 0) + \
+                   counts.get(prefix + " coalesced", 0)
+            lines.append("%s hit rate: %.1f%%" % (prefix,
+                         100.0 * hits / (hits + counts[name])))
+    for name in names:
+        lines.append("%s: p50=%.3f p95=%.3f p99=%.3f (of %d)" % (name,
+                     percentile(name, 50), percentile(name, 95),
+                     percentile(name, 99), __sampled[name]))
+    logging.info("Run metrics:\n\t" + "\n\t".join(lines))
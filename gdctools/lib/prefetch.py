@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+prefetch.py: consumption of an iterable in a background thread, through a
+bounded queue
+'''
+
+# }}}
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_END = object()
+
+# The Prefetch (if any) on whose behalf the current thread is working
+_local = threading.local()
+
+def carried(func):
+    '''Return func, wrapped to run on behalf of the same Prefetch as the
+    calling thread, e.g. when it is handed to a pool of worker threads, so
+    that what it logs is held along with the records of that Prefetch'''
+    owner = getattr(_local, 'owner', None)
+    if owner is None:
+        return func
+    def run(*args, **kwargs):
+        previous = getattr(_local, 'owner', None)
+        _local.owner = owner
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.owner = previous
+    return run
+
+class Prefetch(object):
+    '''Iterate, in a background thread, over the iterable returned by
+    source(), holding at most size of its items until they are consumed by
+    iterating over this object.  An exception raised by the source is raised
+    again to the consumer, where it would have occurred.  The value returned
+    by source may be a (context, iterable) pair, in which case context is
+    made available as the context attribute (once ready() returns).  If
+    hold_logs is set, records logged by the background thread, or by work
+    it hands to other threads by way of carried(), are held until ready() is
+    first called, so that they do not interleave with the log of whatever
+    the consumer is doing meanwhile.
+
+    Sample Usage:
+    records = Prefetch(lambda: query.iter_hits(), 1000)
+    ...                                 # while the records are fetched
+    for record in records:
+        ...
+    records.close()
+    '''
+
+    def __init__(self, source, size=1000, pair=False, name="prefetch",
+                 hold_logs=False):
+        self.context = None
+        self._source = source
+        self._pair = pair
+        self._queue = queue.Queue(maxsize=max(1, int(size)))
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._produce, name=name)
+        self._thread.daemon = True
+        self._held = None
+        self._held_lock = threading.Lock()
+        self._handlers = []
+        if hold_logs:
+            self._held = []
+            self._handlers = logging.getLogger().handlers[:]
+            for handler in self._handlers:
+                handler.addFilter(self._hold)
+        self._thread.start()
+
+    def ready(self):
+        '''Wait until the source has been called, returning its context; any
+        records held from the log are emitted first'''
+        self._release_logs()
+        self._ready.wait()
+        return self.context
+
+    def __iter__(self):
+        self.ready()
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                item.reraise()
+            yield item
+
+    def close(self):
+        '''Stop producing items, e.g. when the consumer stops early'''
+        self._closed.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._ready.set()
+        self._release_logs()
+
+    def _hold(self, record):
+        # A filter upon each handler of the root logger, which holds back the
+        # records logged on behalf of this (once, whatever the handler)
+        if getattr(_local, 'owner', None) is not self:
+            return True
+        with self._held_lock:
+            if self._held is None:
+                return True
+            if not self._held or self._held[-1] is not record:
+                self._held.append(record)
+            return False
+
+    def _release_logs(self):
+        with self._held_lock:
+            held, self._held = self._held, None
+        if held is None:
+            return
+        for handler in self._handlers:
+            handler.removeFilter(self._hold)
+        root_logger = logging.getLogger()
+        for record in held:
+            root_logger.handle(record)
+
+    def _produce(self):
+        _local.owner = self
+        try:
+            items = self._source()
+            if self._pair:
+                self.context, items = items
+            self._ready.set()
+            for item in items:
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._ready.set()
+            self._put(_Failure(e))
+            return
+        self._put(_END)
+
+    def _put(self, item):
+        # Waits for room in the queue, unless the consumer has gone away
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+class _Failure(object):
+    '''An exception raised by the source, to be raised again by the consumer'''
+    def __init__(self, error):
+        self.error = error
+
+    def reraise(self):
+        raise self.error
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+progress.py: ordered logging of the progress of items processed concurrently
+'''
+
+# }}}
+
+import time
+import logging
+import threading
+
+class ProgressLog(object):
+    '''Log the completion of items numbered from 1, in that order, plus a
+    summary of how many of total have completed (or failed), and the bytes
+    they comprise, at least every interval seconds.  The total may be given
+    as a callable, for when it is not known until items are underway.
+
+    Sample Usage:
+    progress = ProgressLog("Clinical files", 100)
+    ...
+    progress.done(n, "Mirrored file " + name, nbytes=size)    # in any order
+    ...
+    progress.close()
+    '''
+
+    def __init__(self, name, total, interval=10.0):
+        self.name = name
+        self.interval = interval
+        self.completed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.nbytes = 0
+        self._total = total
+        self._pending = dict()          # messages of items logged out of turn
+        self._next = 1
+        self._lock = threading.Lock()
+        self._started = self._reported = time.time()
+        self._summarized = 0            # items completed as of last summary
+
+    def total(self):
+        return self._total() if callable(self._total) else self._total
+
+    def done(self, n, message=None, nbytes=0, failed=False):
+        '''Note that item n has completed (or failed), and log message for
+        it once every item before it has been logged'''
+        with self._lock:
+            self.completed += 1
+            self.failed += 1 if failed else 0
+            self.nbytes += nbytes
+            self._pending[n] = (message, failed)
+            while self._next in self._pending:
+                message, failed = self._pending.pop(self._next)
+                if message:
+                    message += " | {0} of {1}".format(self._next, self.total())
+                    if failed:
+                        logging.error(message)
+                    else:
+                        logging.info(message)
+                self._next += 1
+            if time.time() - self._reported >= self.interval:
+                self._summarize()
+
+    def skip(self, n):
+        '''Note that item n needed no processing, so is not logged'''
+        with self._lock:
+            self.completed += 1
+            self.skipped += 1
+            self._pending[n] = (None, False)
+            while self._next in self._pending:
+                self._pending.pop(self._next)
+                self._next += 1
+
+    def close(self):
+        '''Log any items still held back (e.g. if numbers were skipped), and
+        the final summary'''
+        with self._lock:
+            for n in sorted(self._pending):
+                message, failed = self._pending[n]
+                if message:
+                    message += " | {0} of {1}".format(n, self.total())
+                    (logging.error if failed else logging.info)(message)
+            self._pending.clear()
+            if self.completed > self.skipped and \
+                    self.completed != self._summarized:
+                self._summarize()
+
+    def _summarize(self):
+        elapsed = max(time.time() - self._started, 1e-6)
+        logging.info("%s: %d of %d done (%d skipped, %d failed), %.1f MB at "
+                     "%.2f MB/s" % (self.name, self.completed, self.total(),
+                                    self.skipped, self.failed,
+                                    self.nbytes / 1e6,
+                                    self.nbytes / 1e6 / elapsed))
+        self._reported = time.time()
+        self._summarized = self.completed
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+standin.py: a local stand-in for the GDC API, serving recorded fixtures or
+a synthetic corpus, so that GDCtools can be exercised without network access
+'''
+
+# }}}
+
+from __future__ import print_function
+import os
+import io
+import re
+import json
+import time
+import zlib
+import random
+import hashlib
+import tarfile
+import argparse
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+DATA_RELEASE = "Data Release 0.0 - Stand-in"
+
+# Sort fields by endpoint, mirroring those used by GDCQuery
+ID_FIELDS = {'files': 'file_id', 'cases': 'case_id', 'projects': 'project_id'}
+
+class Corpus(object):
+    '''Records served by the stand-in: a dict of endpoint name to list of
+    records (each a dict, as the GDC would return it with every field and
+    expansion), plus the content of each file keyed by file_id'''
+
+    def __init__(self, records, contents, data_release=DATA_RELEASE):
+        self.records = records
+        self.contents = contents
+        self.data_release = data_release
+        self.revisions = 0
+
+    @staticmethod
+    def from_fixtures(fixture_dir):
+        '''Load <endpoint>.json record lists and data/<uuid> file contents
+        (e.g. as recorded from real GDC responses) from fixture_dir'''
+        records = dict()
+        for endpoint in ID_FIELDS:
+            path = os.path.join(fixture_dir, endpoint + '.json')
+            if os.path.isfile(path):
+                with open(path) as f:
+                    records[endpoint] = json.load(f)
+            else:
+                records[endpoint] = []
+        contents = dict()
+        data_dir = os.path.join(fixture_dir, 'data')
+        if os.path.isdir(data_dir):
+            for uuid in os.listdir(data_dir):
+                with open(os.path.join(data_dir, uuid), 'rb') as f:
+                    contents[uuid] = f.read()
+        release = DATA_RELEASE
+        status = os.path.join(fixture_dir, 'status.json')
+        if os.path.isfile(status):
+            with open(status) as f:
+                release = json.load(f).get('data_release', release)
+        return Corpus(records, contents, release)
+
+    @staticmethod
+    def synthetic(programs=('TCGA',), projects_per_program=2,
+                  cases_per_project=3, big_file_size=0, seed=0):
+        '''Generate a small, deterministic corpus resembling TCGA: each case
+        has clinical & biospecimen XML plus a copy number segment file, and
+        (if big_file_size is given) one large file per project'''
+        rng = random.Random(seed)
+        def uuid():
+            h = '%032x' % rng.getrandbits(128)
+            return '-'.join([h[:8], h[8:12], h[12:16], h[16:20], h[20:]])
+
+        projects, cases, files = [], [], []
+        contents = dict()
+        stamp = '2018-09-%02dT00:%02d:00.000000-05:00'
+
+        def add_file(case_list, category, data_type, data_format, name, size,
+                     project_id, day, minute=0):
+            file_id = uuid()
+            body = bytearray(rng.getrandbits(8) for _ in range(min(size, 4096)))
+            body = bytes(body * (size // max(len(body), 1) + 1))[:size]
+            contents[file_id] = body
+            files.append({
+                'id': file_id, 'file_id': file_id, 'file_name': name,
+                'data_category': category, 'data_type': data_type,
+                'data_format': data_format, 'access': 'open',
+                'experimental_strategy': None, 'platform': None, 'tags': [],
+                'md5sum': hashlib.md5(body).hexdigest(), 'file_size': size,
+                'created_datetime': stamp % (day, minute),
+                'updated_datetime': stamp % (day, minute),
+                'center': {'namespace': 'standin.org'},
+                'analysis': {'workflow_type': 'Stand-in Workflow'},
+                'annotations': [],
+                'cases': case_list,
+            })
+
+        categories = [('Clinical', 'Clinical Supplement', 'BCR XML',
+                       'standin.org_clinical.%s.xml'),
+                      ('Biospecimen', 'Biospecimen Supplement', 'BCR XML',
+                       'standin.org_biospecimen.%s.xml'),
+                      ('Copy Number Variation', 'Copy Number Segment', 'TXT',
+                       '%s.segment.v2.seg.txt')]
+
+        for program in programs:
+            for p in range(projects_per_program):
+                project_id = '%s-%s' % (program, chr(ord('A') + p) * 3)
+                proj_files = len(files)
+                for c in range(cases_per_project):
+                    case_id = uuid()
+                    submitter = '%s-XX-%04d' % (program, p * 1000 + c)
+                    sample = {'sample_id': uuid(), 'sample_type': 'Primary Tumor',
+                              'submitter_id': submitter + '-01A',
+                              'portions': [{'submitter_id': submitter + '-01A-11',
+                                'analytes': [{'aliquots': [{'submitter_id':
+                                        submitter + '-01A-11D-A000-01'}]}]}]}
+                    case = {'id': case_id, 'case_id': case_id,
+                            'submitter_id': submitter,
+                            'project': {'project_id': project_id},
+                            'samples': [sample]}
+                    cases.append(case)
+                    file_case = dict(case, samples=[sample])
+                    for day, cat in enumerate(categories, 1):
+                        add_file([file_case], cat[0], cat[1], cat[2],
+                                 cat[3] % submitter, 2000 + 500 * c + day,
+                                 project_id, day, c % 60)
+                if big_file_size:
+                    add_file([dict(cases[-1])], 'Simple Nucleotide Variation',
+                             'Masked Somatic Mutation', 'MAF',
+                             '%s.standin.maf.gz' % project_id, big_file_size,
+                             project_id, 4)
+                proj = files[proj_files:]
+                cats = sorted(set(f['data_category'] for f in proj))
+                projects.append({
+                    'id': project_id, 'project_id': project_id,
+                    'name': 'Stand-in project %s' % project_id,
+                    'primary_site': ['Unknown'],
+                    'program': {'name': program},
+                    'summary': {'file_count': len(proj), 'data_categories': [
+                        {'data_category': cat, 'file_count':
+                         len([f for f in proj if f['data_category'] == cat])}
+                        for cat in cats]}})
+
+        return Corpus({'projects': projects, 'cases': cases, 'files': files},
+                      contents)
+
+    def revise(self, n):
+        '''Issue a new data release, in which the next n files of each
+        project (in the order they were created) have been revised'''
+        self.revisions += 1
+        self.data_release = "%s, revision %d" % (DATA_RELEASE, self.revisions)
+        by_project = dict()
+        for file_d in self.records.get('files', []):
+            project_id = file_d['cases'][0]['project']['project_id']
+            by_project.setdefault(project_id, []).append(file_d)
+        first = (self.revisions - 1) * n
+        for files in by_project.values():
+            for file_d in files[first:first + n]:
+                body = self.contents[file_d['file_id']]
+                body += ('\nrevision %d\n' % self.revisions).encode('ascii')
+                self.contents[file_d['file_id']] = body
+                file_d['md5sum'] = hashlib.md5(body).hexdigest()
+                file_d['file_size'] = len(body)
+                file_d['updated_datetime'] = \
+                    '2018-10-%02dT00:00:00.000000-05:00' % self.revisions
+
+    def save(self, fixture_dir):
+        '''Record this corpus as fixtures, loadable with from_fixtures()'''
+        data_dir = os.path.join(fixture_dir, 'data')
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        for endpoint, records in self.records.items():
+            with open(os.path.join(fixture_dir, endpoint + '.json'), 'w') as f:
+                json.dump(records, f, indent=2)
+        for uuid, body in self.contents.items():
+            with open(os.path.join(data_dir, uuid), 'wb') as f:
+                f.write(body)
+        with open(os.path.join(fixture_dir, 'status.json'), 'w') as f:
+            json.dump({'data_release': self.data_release}, f)
+
+# Query evaluation helpers {{{
+
+def _values(record, path):
+    '''Return the list of values found at dotted path within record,
+    descending through nested lists as the GDC does'''
+    values = [record]
+    for key in path.split('.'):
+        found = []
+        for v in values:
+            if isinstance(v, dict) and v.get(key) is not None:
+                if isinstance(v[key], list):
+                    found.extend(v[key])
+                else:
+                    found.append(v[key])
+        values = found
+    return values
+
+def _field(endpoint, field):
+    # The GDC permits fields to be qualified by the endpoint, e.g. files.access
+    prefix = endpoint + '.'
+    return field[len(prefix):] if field.startswith(prefix) else field
+
+def _matches(endpoint, record, filt):
+    op = filt['op'].lower()
+    content = filt['content']
+    if op == 'and':
+        return all(_matches(endpoint, record, f) for f in content)
+    if op == 'or':
+        return any(_matches(endpoint, record, f) for f in content)
+    found = _values(record, _field(endpoint, content['field']))
+    wanted = content['value']
+    if not isinstance(wanted, list):
+        wanted = [wanted]
+    if op in ('=', 'in'):
+        return any(v in wanted for v in found)
+    if op in ('!=', 'exclude'):
+        return not any(v in wanted for v in found)
+    compare = {'>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+               '<': lambda a, b: a < b, '<=': lambda a, b: a <= b}[op]
+    return any(compare(v, wanted[0]) for v in found)
+
+def _project(record, fields, expand):
+    '''Prune record to the requested fields, plus expanded subtrees'''
+    if not fields and not expand:
+        return dict((k, v) for k, v in record.items()
+                    if not isinstance(v, (dict, list)))
+    result = {'id': record['id']}
+    for path in fields:
+        _copy_path(record, result, path.split('.'), full=False)
+    for path in expand:
+        _copy_path(record, result, path.split('.'), full=True)
+    return result
+
+def _copy_path(src, dst, keys, full):
+    key = keys[0]
+    if key not in src:
+        return
+    value = src[key]
+    if len(keys) == 1:
+        if full or not isinstance(value, (dict, list)):
+            dst[key] = value
+        elif isinstance(value, dict):
+            dst.setdefault(key, dict((k, v) for k, v in value.items()
+                                     if not isinstance(v, (dict, list))))
+        else:
+            dst.setdefault(key, [dict((k, v) for k, v in x.items()
+                                      if not isinstance(v, (dict, list)))
+                                 for x in value])
+        return
+    if isinstance(value, list):
+        existing = dst.setdefault(key, [dict() for _ in value])
+        for s, d in zip(value, existing):
+            _copy_path(s, d, keys[1:], full)
+    elif isinstance(value, dict):
+        _copy_path(value, dst.setdefault(key, dict()), keys[1:], full)
+
+def _split(value):
+    return [v for v in value.split(',') if v] if value else []
+
+# }}}
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'           # permit keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, *args)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        self._dispatch('GET', url.path, params)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        self._dispatch('POST', url.path, body)
+
+    def _dispatch(self, method, path, params):
+        server = self.server
+        server.count_request(path)
+        if server.latency:
+            time.sleep(random.expovariate(1.0 / server.latency))
+        if server.error_rate and random.random() < server.error_rate:
+            return self._send(503, b'{"message": "Injected error"}',
+                              headers={'Retry-After': '0'})
+
+        parts = [p for p in path.split('/') if p and p != 'legacy']
+        if not parts:
+            return self._send(404, b'{}')
+        endpoint = parts[0]
+        if endpoint == 'status':
+            return self._json({'status': 'OK',
+                               'data_release': server.corpus.data_release})
+        if endpoint == 'data':
+            if method == 'POST':
+                return self._archive(params.get('ids', []))
+            return self._file(parts[1] if len(parts) > 1 else '')
+        if endpoint in ID_FIELDS:
+            return self._query(endpoint, params)
+        return self._send(404, b'{"message": "Unknown endpoint"}')
+
+    def _query(self, endpoint, params):
+        records = self.server.corpus.records.get(endpoint, [])
+        filters = params.get('filters')
+        if isinstance(filters, str):
+            filters = json.loads(filters)
+        if filters:
+            records = [r for r in records if _matches(endpoint, r, filters)]
+
+        sort = (params.get('sort') or ID_FIELDS[endpoint]).split(':')[0]
+        records = sorted(records, key=lambda r: (_values(r, sort) or [''])[0])
+
+        fields = params.get('fields') or ''
+        expand = params.get('expand') or ''
+        fields = _split(fields) if isinstance(fields, str) else fields
+        expand = _split(expand) if isinstance(expand, str) else expand
+        fields = [_field(endpoint, f) for f in fields]
+        start = int(params.get('from', 0))
+        size = int(params.get('size', 10))
+        page = records[start:start + size]
+        data = {'hits': [_project(r, fields, expand) for r in page],
+                'pagination': {'total': len(records), 'from': start,
+                               'size': size, 'count': len(page)}}
+
+        facets = params.get('facets') or ''
+        facets = _split(facets) if isinstance(facets, str) else facets
+        if facets:
+            aggregations = dict()
+            for facet in facets:
+                counts = dict()
+                for r in records:
+                    for v in set(_values(r, _field(endpoint, facet))):
+                        counts[v] = counts.get(v, 0) + 1
+                buckets = [{'key': k, 'doc_count': n} for k, n in
+                           sorted(counts.items(), key=lambda kv: -kv[1])]
+                aggregations[facet] = {'buckets': buckets}
+            data['aggregations'] = aggregations
+        return self._json({'data': data, 'warnings': {}})
+
+    def _file(self, uuid):
+        body = self.server.corpus.contents.get(uuid)
+        if body is None:
+            return self._send(404, b'{"message": "File not found"}')
+        headers = {'Accept-Ranges': 'bytes',
+                   'Content-Disposition': 'attachment; filename=' + uuid}
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+        if match:
+            first = int(match.group(1) or 0)
+            last = int(match.group(2)) if match.group(2) else len(body) - 1
+            last = min(last, len(body) - 1)
+            if first >= len(body):
+                headers['Content-Range'] = 'bytes */%d' % len(body)
+                return self._send(416, b'', headers=headers)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(body))
+            return self._send(206, body[first:last + 1], headers=headers,
+                              content_type='application/octet-stream')
+        return self._send(200, body, headers=headers,
+                          content_type='application/octet-stream')
+
+    def _archive(self, ids):
+        corpus = self.server.corpus
+        names = dict((f['file_id'], f['file_name'])
+                     for f in corpus.records.get('files', []))
+        if len(ids) == 1:
+            return self._file(ids[0])
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+            manifest = ['id\tfilename\tmd5\tsize\tstate']
+            for uuid in ids:
+                body = corpus.contents.get(uuid)
+                if body is None:
+                    continue
+                member = tarfile.TarInfo('%s/%s' % (uuid, names.get(uuid, uuid)))
+                member.size = len(body)
+                archive.addfile(member, io.BytesIO(body))
+                manifest.append('%s\t%s\t%s\t%d\tlive' % (uuid, names.get(uuid),
+                                hashlib.md5(body).hexdigest(), len(body)))
+            manifest = ('\n'.join(manifest) + '\n').encode('utf-8')
+            member = tarfile.TarInfo('MANIFEST.txt')
+            member.size = len(manifest)
+            archive.addfile(member, io.BytesIO(manifest))
+        return self._send(200, buf.getvalue(), content_type='application/x-gzip')
+
+    def _json(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return self._send(200, gz.compress(body) + gz.flush(),
+                              headers={'Content-Encoding': 'gzip'})
+        return self._send(200, body)
+
+    def _send(self, status, body, headers=None, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    '''Threaded HTTP server answering GDC API requests from a Corpus'''
+
+    daemon_threads = True
+
+    def __init__(self, corpus, port=0, latency=0.0, error_rate=0.0,
+                 verbose=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandinHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.requests = dict()
+        self._lock = threading.Lock()
+
+    def count_request(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def root(self):
+        '''Return the URL to use as GDC_ROOT for this server'''
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        '''Serve requests from a background (daemon) thread'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+def main():
+    cli = argparse.ArgumentParser(description='Serve a local stand-in for '
+                        'the GDC API, from fixtures or a synthetic corpus')
+    cli.add_argument('-p', '--port', type=int, default=8089,
+            help='Port to listen on [%(default)s]')
+    cli.add_argument('-f', '--fixtures',
+            help='Serve records & files recorded in this folder, instead of '
+            'a synthetic corpus')
+    cli.add_argument('-r', '--record',
+            help='Write the synthetic corpus to this folder as fixtures')
+    cli.add_argument('--projects', type=int, default=2,
+            help='Synthetic projects per program [%(default)s]')
+    cli.add_argument('--cases', type=int, default=3,
+            help='Synthetic cases per project [%(default)s]')
+    cli.add_argument('--big-file-size', type=int, default=0,
+            help='Add one file of this many bytes to each synthetic project')
+    cli.add_argument('--releases', type=int, default=0,
+            help='New data releases to issue, each revising --revised files '
+            'of each project [%(default)s]')
+    cli.add_argument('--revised', type=int, default=2,
+            help='Files of each project revised per release [%(default)s]')
+    cli.add_argument('--latency', type=float, default=0.0,
+            help='Mean latency (seconds) injected into each response')
+    cli.add_argument('--error-rate', type=float, default=0.0,
+            help='Fraction of requests to answer with HTTP 503')
+    cli.add_argument('-V', '--verbose', action='store_true',
+            help='Log each request')
+    args = cli.parse_args()
+
+    if args.fixtures:
+        corpus = Corpus.from_fixtures(args.fixtures)
+    else:
+        corpus = Corpus.synthetic(projects_per_program=args.projects,
+                                  cases_per_project=args.cases,
+                                  big_file_size=args.big_file_size)
+    for _ in range(args.releases):
+        corpus.revise(args.revised)
+    if args.record:
+        corpus.save(args.record)
+
+    server = StandinServer(corpus, args.port, args.latency, args.error_rate,
+                           args.verbose)
+    print('GDC stand-in serving at ' + server.root())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Front Matter {{{
+'''
+throttle.py: adaptive (AIMD) limit upon the number of downloads in flight
+'''
+
+# }}}
+
+import time
+import logging
+import threading
+import contextlib
+
+class AdaptiveLimiter(object):
+    '''Bound the number of concurrent operations (e.g. downloads) between
+    floor and ceiling.  Every interval seconds the observed throughput is
+    compared to that of the previous interval: while it keeps rising the limit
+    grows by 1, but after any failure, or when throughput falls while the
+    median latency per byte exceeds latency_factor times its baseline, the
+    limit is cut by backoff.  Latency is taken per byte, so that a change in
+    operation size is not mistaken for a spike, and the baseline is reset
+    after spike_intervals spikes in a row.  A budget (e.g. a
+    multiprocessing.BoundedSemaphore) may further bound the operations of
+    several limiters, e.g. one in each of several processes.
+
+    Sample Usage:
+    limiter = AdaptiveLimiter(1, 8)
+    with limiter.slot() as slot:
+        slot['bytes'] = download(...)
+    '''
+
+    def __init__(self, floor=1, ceiling=8, interval=5.0, backoff=0.5,
+                 latency_factor=3.0, name="Download", budget=None,
+                 spike_intervals=3, clock=time.time):
+        self.floor = max(1, int(floor))
+        self.ceiling = max(self.floor, int(ceiling))
+        self.limit = self.floor
+        self.interval = interval
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.name = name
+        self.budget = budget
+        self.spike_intervals = spike_intervals
+        self._clock = clock
+        self.total_bytes = 0
+        self.total_errors = 0
+        self._active = 0
+        self._cond = threading.Condition()
+        self._started = clock()
+        self._baseline = None           # running median latency per byte
+        self._throughput = None         # of previous interval
+        self._spikes = 0                # consecutive intervals with spikes
+        self._last_cut = 0
+        self._reset_interval()
+
+    @contextlib.contextmanager
+    def slot(self):
+        '''Context in which one operation is performed, once the limit allows;
+        the operation should record the bytes it transferred in slot['bytes']'''
+        self.acquire()
+        start = self._clock()
+        record = {'bytes': 0}
+        try:
+            yield record
+        except Exception:
+            self.release(self._clock() - start, record['bytes'], error=True)
+            raise
+        self.release(self._clock() - start, record['bytes'])
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+        if self.budget is not None:
+            self.budget.acquire()
+
+    def release(self, latency, nbytes=0, error=False):
+        if self.budget is not None:
+            self.budget.release()
+        with self._cond:
+            self._active -= 1
+            self._bytes += nbytes
+            self.total_bytes += nbytes
+            if nbytes > 0:
+                self._latencies.append(latency / nbytes)
+            if error:
+                self._errors += 1
+                self.total_errors += 1
+            self._adjust(error)
+            self._cond.notify_all()
+
+    def error(self, exception=None):
+        '''Signal an error in an operation still under way (e.g. a request
+        which it will retry), so that the limit is cut at once, rather than
+        only once the operation fails outright'''
+        with self._cond:
+            self._errors += 1
+            self._adjust(True)
+            self._cond.notify_all()
+
+    def throughput(self):
+        '''Return overall throughput, in bytes per second'''
+        return self.total_bytes / max(self._clock() - self._started, 1e-6)
+
+    def _adjust(self, error):
+        now = self._clock()
+        elapsed = now - self._interval_start
+
+        # Errors cut the limit at once, except right after a cut, so that a
+        # burst of errors counts as one signal (but is still noted below)
+        if error and now - self._last_cut < 1.0:
+            error = False
+        if not error and elapsed < self.interval:
+            return
+        error = error or self._errors > 0
+
+        latencies = sorted(self._latencies)
+        median = latencies[len(latencies) // 2] if latencies else None
+        throughput = self._bytes / max(elapsed, 1e-6)
+        spike = (median is not None and self._baseline is not None and
+                 median > self.latency_factor * self._baseline and
+                 self._throughput is not None and
+                 throughput < self._throughput)
+        self._spikes = self._spikes + 1 if spike else 0
+
+        previous = self.limit
+        if error or spike:
+            self.limit = max(self.floor, int(self.limit * self.backoff))
+            self._last_cut = now
+        elif self._throughput is None or throughput >= self._throughput:
+            self.limit = min(self.ceiling, self.limit + 1)
+
+        if median is not None:
+            if self._baseline is None or self._spikes >= self.spike_intervals:
+                # First interval, or latency has risen for good
+                self._baseline = median
+                self._spikes = 0
+            elif not spike:
+                self._baseline = 0.8 * self._baseline + 0.2 * median
+        self._throughput = throughput
+
+        msg = "%s concurrency %d -> %d: %.2f MB/s, %d error(s), median " \
+              "latency %.2fs/MB" % (self.name, previous, self.limit,
+                                    throughput / 1e6, self._errors,
+                                    (median or 0) * 1e6)
+        if error or spike:
+            msg += " (backing off after %s)" % ("error" if error else "spike")
+        logging.info(msg)
+        self._reset_interval()
+
+    def _reset_interval(self):
+        self._interval_start = self._clock()
+        self._bytes = 0
+        self._errors = 0
+        self._latencies = []
@@ -63,5 +63,11 @@ setup(
         'matplotlib==2.1.1', # v2.1.1 avoids hardcoded dependency on bz2 module
         'future',
         'configparser',
+        'futures; python_version < "3.0"',
     ],
+    # Faster decoding & encoding of JSON (see gdctools/lib/codec.py)
+    extras_require = {
+        'fast': ['orjson; python_version >= "3.6"',
+                 'ujson; python_version < "3.6"'],
+    },
 )
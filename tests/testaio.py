@@ -0,0 +1,77 @@
+# Regression test for the asyncio API, against a local stand-in for the GDC:
+# queries, counts and facets must agree with the synchronous API, and async
+# downloads must be verified against the md5 and size given for them.
+
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+from gdctools.lib import api, aio, standin
+
+errors = []
+def check(condition, message):
+    if not condition:
+        errors.append(message)
+
+corpus = standin.Corpus.synthetic()
+server = standin.StandinServer(corpus).start()
+client = api.GDCClient(root=server.root())
+download_dir = tempfile.mkdtemp()
+
+def files_query():
+    query = aio.AsyncGDCQuery('files', client=client)
+    query.add_eq_filter('cases.project.project_id', 'TCGA-AAA')
+    return query.add_fields('file_id', 'md5sum', 'file_size', 'data_category')
+
+async def main():
+    query = aio.AsyncGDCQuery('projects', client=client)
+    projects = await query.add_fields('project_id').get()
+    check(sorted(p['project_id'] for p in projects) == ['TCGA-AAA', 'TCGA-BBB'],
+          "async query should return all projects")
+
+    files = await files_query().get(page_size=2)
+    expected = api.GDCQuery('files', client=client)
+    expected.add_eq_filter('cases.project.project_id', 'TCGA-AAA')
+    check(files == expected.add_fields('file_id', 'md5sum', 'file_size',
+                                       'data_category').get(),
+          "async query should return the same hits as GDCQuery")
+    check(await files_query().count() == len(files),
+          "async count should equal the number of hits")
+    facets = await files_query().add_facets('data_category').facets()
+    check(sum(facets['data_category'].values()) == len(files),
+          "async facet counts should total the number of hits")
+    try:
+        files_query()._query_paginator()
+        check(False, "blocking paginator of async query should raise")
+    except TypeError:
+        pass
+
+    # Downloads are verified against the given md5 and size
+    file_d = files[0]
+    path = os.path.join(download_dir, file_d['file_id'])
+    await aio.download_file(file_d['file_id'], path, client=client,
+                            md5sum=file_d['md5sum'],
+                            file_size=file_d['file_size'])
+    with open(path, 'rb') as f:
+        check(f.read() == corpus.contents[file_d['file_id']],
+              "async download should match the file content")
+    path += '.bad'
+    try:
+        await aio.download_file(file_d['file_id'], path, client=client,
+                                md5sum='0' * 32)
+        check(False, "async download with wrong md5sum should raise")
+    except IOError:
+        pass
+    check(not os.path.exists(path) and not os.path.exists(path + '.part'),
+          "async download failing verification should leave no file")
+
+asyncio.run(main())
+server.shutdown()
+shutil.rmtree(download_dir)
+if errors:
+    print("ERROR: asyncio API misbehaved:\n\t" + "\n\t".join(errors) + "\n")
+    sys.exit(1)
+else:
+    print("GOOD: asyncio API behaved properly\n")
+    sys.exit(0)
@@ -0,0 +1,151 @@
+# Regression test for paged queries and downloads, against a local stand-in
+# for the GDC: pages which shift under a query must be detected, IN filters
+# split into chunks must merge to the unsplit result, downloads must resume
+# from .part files and be discarded when they fail verification, and the
+# circuit breaker must not be left waiting upon a probe which died.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import requests
+from gdctools.lib import api, standin
+
+errors = []
+def check(condition, message):
+    if not condition:
+        errors.append(message)
+
+corpus = standin.Corpus.synthetic(big_file_size=100000)
+server = standin.StandinServer(corpus).start()
+client = api.GDCClient(root=server.root())
+client.query_workers = 1
+download_dir = tempfile.mkdtemp()
+files = corpus.records['files']
+
+def files_query():
+    return api.GDCQuery('files', client=client).add_fields('file_id')
+
+# A file removed (or added) while paging shifts the pages which follow it,
+# so that a hit is dropped (or duplicated); either must raise
+def shift_pages(change, undo, what):
+    hits = files_query().iter_hits(page_size=2)
+    next(hits)                  # first page fetched, second one requested
+    change()
+    try:
+        list(hits)
+        check(False, "query should raise when a hit is %s while paging" % what)
+    except ValueError:
+        pass
+    undo()
+
+first = min(files, key=lambda f: f['file_id'])
+shift_pages(lambda: files.remove(first), lambda: files.append(first),
+            "dropped")
+earlier = dict(first, id='0' * 8, file_id='0' * 8)
+shift_pages(lambda: files.append(earlier), lambda: files.remove(earlier),
+            "duplicated")
+
+# IN filters of more than MAX_IN_VALUES values are split into chunks, whose
+# hits are merged in id order and deduplicated; a file of cases in two chunks
+# is then counted twice by .total
+cases = [c['case_id'] for c in corpus.records['cases']]
+files[0]['cases'] = files[0]['cases'] + [corpus.records['cases'][-1]]
+unsplit = files_query().add_in_filter('cases.case_id', cases).get()
+max_in_values = api.GDCQuery.MAX_IN_VALUES
+api.GDCQuery.MAX_IN_VALUES = 2
+query = files_query().add_in_filter('cases.case_id', cases)
+check(len(query._chunks()) == 3, "IN filter should be split into 3 chunks")
+merged = list(query.iter_hits(page_size=2))
+api.GDCQuery.MAX_IN_VALUES = max_in_values
+check(merged == unsplit, "chunked query should return the unsplit hits")
+check(query.total == len(merged) + 1,
+      "total of chunked query should count the shared file twice")
+
+# A truncated .part file is resumed with a Range request
+file_d = [f for f in files if f['file_size'] < 100000][0]
+content = corpus.contents[file_d['file_id']]
+path = os.path.join(download_dir, file_d['file_name'])
+with open(path + '.part', 'wb') as f:
+    f.write(content[:1000])
+r = client.download_file(file_d['file_id'], path, md5sum=file_d['md5sum'],
+                         file_size=file_d['file_size'])
+check(r.status_code == 206, "download should resume from its .part file")
+with open(path, 'rb') as f:
+    check(f.read() == content, "resumed download should match the content")
+
+# A download failing its md5 check is deleted, .part and all, so that it is
+# fetched afresh when retried
+os.remove(path)
+with open(path + '.part', 'wb') as f:
+    f.write(b'\0' * 1000)
+try:
+    client.download_file(file_d['file_id'], path, md5sum=file_d['md5sum'])
+    check(False, "download of corrupt .part file should fail md5 check")
+except IOError:
+    pass
+check(not os.path.exists(path) and not os.path.exists(path + '.part'),
+      "download failing md5 check should leave no file")
+client.download_file(file_d['file_id'], path, md5sum=file_d['md5sum'])
+with open(path, 'rb') as f:
+    check(f.read() == content, "retried download should match the content")
+
+# A .ranges record left by another download is discarded, rather than the
+# zeros preallocated in its .part file being taken as downloaded bytes
+client.multipart_parts, client.multipart_min_size = 4, 50000
+big = [f for f in files if f['file_size'] == 100000][0]
+path = os.path.join(download_dir, big['file_name'])
+with open(path + '.part', 'wb') as f:
+    f.truncate(100000)
+with open(path + '.part.ranges', 'w') as f:
+    json.dump({'size': 100000, 'md5': '0' * 32,
+               'ranges': [[0, 50000, 50000], [50000, 50000, 100000]]}, f)
+r = client.download_file(big['file_id'], path, md5sum=big['md5sum'],
+                         file_size=big['file_size'])
+with open(path, 'rb') as f:
+    check(f.read() == corpus.contents[big['file_id']],
+          "ranged download should ignore a stale .ranges record")
+check(r is not None and r.status_code == 206,
+      "ranged download should return the response to its last range")
+
+# The half-open probe of the circuit breaker may die of an error cut short in
+# transit (which is retried), or of one not worth retrying; either way the
+# requests which follow must not wait upon it forever
+def read_failing(error):
+    read_within = client._read_within
+    def fail(*args):
+        client._read_within = read_within
+        raise error
+    client._read_within = fail
+
+def probe(error, retries):
+    breaker = api.CircuitBreaker(threshold=1, cooldown=0.1)
+    client._breaker = breaker
+    client.retry_policy = api.RetryPolicy(retries=retries, backoff=0.01)
+    breaker.failure()
+    read_failing(error)
+    try:
+        client.data_release()
+    except Exception:
+        pass
+    thread = threading.Thread(target=client.data_release)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    return not thread.is_alive() and not breaker._probing
+
+check(probe(requests.exceptions.ChunkedEncodingError("cut short"), 1),
+      "probe dying of ChunkedEncodingError should be retried")
+check(probe(ValueError("unexpected"), 0),
+      "probe dying of an unexpected error should release the breaker")
+
+server.shutdown()
+shutil.rmtree(download_dir)
+if errors:
+    print("ERROR: GDC API misbehaved:\n\t" + "\n\t".join(errors) + "\n")
+    sys.exit(1)
+else:
+    print("GOOD: GDC API behaved properly\n")
+    sys.exit(0)
@@ -0,0 +1,60 @@
+
+# Regression test for the on-disk query cache: entries must be replayed
+# verbatim, evicted in least-recently-used order when the cache exceeds its
+# size cap, and discarded entirely when the GDC data release changes.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from gdctools.lib.cache import QueryCache
+
+errors = []
+def check(condition, message):
+    if not condition:
+        errors.append(message)
+
+cache_dir = tempfile.mkdtemp()
+hits = [{'id': str(i), 'file_id': str(i), 'cases': [{'case_id': i}]}
+        for i in range(100)]
+
+cache = QueryCache(cache_dir, "Data Release 1.0")
+key = cache.key("files", {"filters": "dummy"})
+check(cache.load(key) is None, "empty cache should not contain query")
+
+# Entries are committed only once all hits have been consumed
+recorder = cache.record(key, iter(hits))
+next(recorder)
+check(cache.load(key) is None, "partially recorded query should not be cached")
+recorded = [hits[0]] + list(recorder)
+check(recorded == hits, "recording should pass hits through unchanged")
+
+total, replayed = cache.load(key)
+check(total == len(hits), "cached total should equal number of hits")
+check(list(replayed) == hits, "cached hits should be replayed verbatim")
+
+# Once the size cap is exceeded, the least recently used entries go first
+entry_size = os.path.getsize(os.path.join(cache_dir, key + '.json'))
+cache = QueryCache(cache_dir, "Data Release 1.0", max_bytes=2 * entry_size)
+keys = [key] + [cache.key("files", {"filters": n}) for n in range(2)]
+for k in keys[1:]:
+    time.sleep(0.01)
+    list(cache.record(k, iter(hits)))
+check(cache.load(keys[0]) is None, "least recently used entry should be evicted")
+check(cache.load(keys[1]) is not None, "recent entry should be retained")
+check(cache.load(keys[2]) is not None, "most recent entry should be retained")
+
+# A new data release invalidates everything cached from the previous one
+cache = QueryCache(cache_dir, "Data Release 1.0")
+check(cache.load(keys[2]) is not None, "same release should retain entries")
+cache = QueryCache(cache_dir, "Data Release 2.0")
+check(cache.load(keys[2]) is None, "new data release should clear cache")
+
+shutil.rmtree(cache_dir)
+if errors:
+    print("ERROR: query cache misbehaved:\n\t" + "\n\t".join(errors) + "\n")
+    sys.exit(1)
+else:
+    print("GOOD: query cache behaved properly\n")
+    sys.exit(0)
@@ -0,0 +1,67 @@
+# Regression test for the adaptive download limiter: a change of file size
+# (e.g. from small XML files to large MAF files) must not be mistaken for a
+# latency spike, nor pin the limit to its floor once latency rises for good.
+
+import sys
+from gdctools.lib.throttle import AdaptiveLimiter
+
+errors = []
+def check(condition, message):
+    if not condition:
+        errors.append(message)
+
+class Clock(object):
+    now = 0.0
+    def __call__(self):
+        return self.now
+
+def run(limiter, clock, intervals, size, latency):
+    '''Simulate intervals in which each slot completes operations of the
+    given size and latency, back to back, so throughput scales with limit'''
+    for _ in range(intervals):
+        ops = limiter.limit * max(1, int(limiter.interval / latency))
+        for _ in range(ops):
+            limiter.acquire()
+            limiter.release(latency, size)
+        clock.now += limiter.interval
+        limiter.acquire()
+        limiter.release(latency, size)
+
+clock = Clock()
+limiter = AdaptiveLimiter(1, 8, interval=5.0, clock=clock)
+
+# Small files: the limit should climb to the ceiling
+run(limiter, clock, 12, 100 * 1000, 0.2)
+check(limiter.limit == 8, "limit should reach ceiling on small files, "
+      "not %d" % limiter.limit)
+
+# Large files take far longer each, but move more bytes per second
+run(limiter, clock, 12, 500 * 1000 * 1000, 5.0)
+check(limiter.limit == 8, "limit should stay at ceiling on large files, "
+      "not %d" % limiter.limit)
+check(limiter.total_errors == 0, "no errors should have been counted")
+
+# Latency per byte rises for good (e.g. a slower file server): the limit may
+# back off, but the baseline must follow so that the limit then recovers
+baseline = limiter._baseline
+run(limiter, clock, 3, 1000 * 1000, 0.5)
+check(limiter._baseline > baseline, "baseline should move during a long spike")
+run(limiter, clock, 12, 1000 * 1000, 0.5)
+check(limiter.limit == 8, "limit should recover after latency rises for "
+      "good, not %d" % limiter.limit)
+
+# A throttling response to a request which will be retried cuts the limit at
+# once, while its download still holds a slot
+clock.now += 2.0
+limiter.acquire()
+limiter.error()
+check(limiter.limit == 4, "limit should be halved upon a retried request, "
+      "not %d" % limiter.limit)
+limiter.release(0.5, 1000 * 1000)
+
+if errors:
+    print("ERROR: adaptive limiter misbehaved:\n\t" + "\n\t".join(errors) + "\n")
+    sys.exit(1)
+else:
+    print("GOOD: adaptive limiter behaved properly\n")
+    sys.exit(0)